@@ -1,3 +1,21 @@
-from .backend import *
-from .frontend import *
-from . import globals
\ No newline at end of file
+import importlib
+
+# The subpackages are imported on first use instead of here, so importing a
+# single module (e.g. the stacking job in a spawned worker process) does not
+# load the UI, GStreamer and the GPIO drivers. Names re-exported by the
+# subpackages stay available as attributes of the package.
+_SUBMODULES = ('backend', 'frontend', 'globals', 'utils', 'simulation', 'benchmarks')
+_REEXPORTED = ('backend', 'frontend')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if not name.startswith('_'):
+        for module_name in _REEXPORTED:
+            module = importlib.import_module(f'.{module_name}', __name__)
+            try:
+                return getattr(module, name)
+            except AttributeError:
+                pass
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
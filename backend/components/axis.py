@@ -1,7 +1,7 @@
 from distutils.log import ERROR
 from unittest.loader import VALID_MODULE_NAME
 import RPi.GPIO as GPIO
-from time import sleep
+from time import sleep, monotonic
 #import Entomoscope.backend.configuration as configuration
 
 class Axis():
@@ -11,6 +11,11 @@ class Axis():
     __VELOCITY_MOVING_CALIBRATE_SLOW = 2_000
     __CURRENT_POSITION_STEPS = 0
     __IS_REFERENCED = False
+    # monotonic time the last move was completed at
+    __LAST_MOVE_TIME = 0.0
+    # (start position, steps, speed, start time) of the running sweep
+    __SWEEP = None
+    __SPEED_BEFORE_SWEEP = None
 
     def __init__(self,
     motor,
@@ -159,6 +164,54 @@ class Axis():
 
 
 
+    def start_sweep_up(self, distance, speed, kind = False) -> float:
+        """
+        Starts moving the axis up by a given distance at a given speed in
+        microsteps per second without waiting, e.g. for frames taken while
+        moving. Returns the monotonic start time; sweep_position gives the
+        position at a later time and finish_sweep has to be called at the end.
+        If the sweep can not be started, the speed of the motor is restored.
+        kind defines the type that is used.
+        False - micrometer (default)
+        True - Microsteps
+        """
+        if not self.__IS_REFERENCED:
+            raise ERROR ("Axis can't be moved when not referenced!")
+        if not kind:
+            dist_step = self._micrometer_to_mic_steps(distance)
+        else:
+            dist_step = distance
+        self.__SWEEP = None
+        if not self._in_range(dist_step, 'up'):
+            raise ValueError ("Sweep exceeds axis maximum position")
+        self.__SPEED_BEFORE_SWEEP = self.motor.speed
+        self.motor.change_speed(speed)
+        try:
+            start_time = self.motor.start_turn_right_for(dist_step)
+        except Exception:
+            self.motor.change_speed(self.__SPEED_BEFORE_SWEEP)
+            raise
+        self.__SWEEP = (self.__CURRENT_POSITION_STEPS, dist_step, speed, start_time)
+        return start_time
+
+    def sweep_position(self, timestamp) -> float:
+        """
+        Position in microsteps at a monotonic timestamp during the sweep,
+        interpolated from the constant step rate of the wave.
+        """
+        start_position, steps, speed, start_time = self.__SWEEP
+        moved = min(max(0.0, (timestamp - start_time) * speed), steps)
+        return start_position + moved
+
+    def finish_sweep(self) -> None:
+        """Waits for the end of the sweep and restores the speed of the motor, also if waiting fails"""
+        try:
+            _, steps, _, _ = self.__SWEEP
+            self.motor.wait_until_stopped(0.01)
+            self._current_position(steps, 'up')
+        finally:
+            self.motor.change_speed(self.__SPEED_BEFORE_SWEEP)
+
     def highest_position(self) -> int:
         return (round((self.size / self.dist_per_mic_step) -
         (self.gap_top/self.dist_per_mic_step)))
@@ -169,6 +222,18 @@ class Axis():
     def get_position(self):
         return self.__CURRENT_POSITION_STEPS
     
+    def last_move_time(self) -> float:
+        """Monotonic time the last move was completed at"""
+        return self.__LAST_MOVE_TIME
+
+    def micrometer_to_mic_steps(self, micrometer) -> int:
+        """Distance in micrometers as microsteps of this axis (rounded)"""
+        return self._micrometer_to_mic_steps(micrometer)
+
+    def mic_steps_to_micrometer(self, mic_steps) -> float:
+        """Microsteps of this axis as distance in micrometers (rounded)"""
+        return self._mic_steps_to_micrometer(mic_steps)
+
     def is_referenced(self):
         return self.__IS_REFERENCED
     
@@ -190,6 +255,8 @@ class Axis():
         elif direction == 'up':
             self.__CURRENT_POSITION_STEPS = self.__CURRENT_POSITION_STEPS + value
 
+        self.__LAST_MOVE_TIME = monotonic()
+
     def _mic_steps_to_micrometer(self, mic_steps) -> float:
         """
         Converts microsteps in micrometer depending on th motor and axis.
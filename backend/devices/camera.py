@@ -0,0 +1,121 @@
+import logging
+import subprocess
+import time
+import cv2
+import numpy as np
+import Entomoscope.globals as globals
+
+
+class LibcameraStillCamera():
+    """
+    Starts libcamera-still for every frame. The camera is opened, configured
+    and converged each time, so this is slow and only the fallback when no
+    persistent backend is available.
+    """
+    persistent = False
+    exclusive = True
+    waits_for_axis = False
+
+    def __init__(self, timeout = 60):
+        self.timeout = timeout
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def capture_to_file(self, image_path) -> str:
+        """Captures a PNG to image_path and returns the output of libcamera-still"""
+        result = subprocess.run(
+            ['libcamera-still','-n','-e','png','-t1', f'-o{image_path}'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=self.timeout
+        )
+        return result.stdout.decode('utf-8')
+
+    def capture(self) -> np.ndarray:
+        """Captures a frame as BGR image"""
+        result = subprocess.run(
+            ['libcamera-still','-n','-e','png','-t1', '-o-'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=self.timeout
+        )
+        image = cv2.imdecode(np.frombuffer(result.stdout, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise IOError('libcamera-still returned no image')
+        return image
+
+
+class Picamera2Camera():
+    """
+    Keeps the camera open and configured for stills between open and close,
+    so a frame only costs the sensor readout. Frames are returned in memory.
+    libcamera allows only one user of the camera, so the live view has to be
+    stopped while it is open.
+    """
+    persistent = True
+    exclusive = True
+    waits_for_axis = False
+
+    def __init__(self, camera_num = 0, settle_time = None):
+        self.camera_num = camera_num
+        self.settle_time = globals.CAMERA_SETTLE_TIME if settle_time is None else settle_time
+        self.camera = None
+
+    def open(self) -> None:
+        if self.camera is not None:
+            return
+        from picamera2 import Picamera2
+        self.camera = Picamera2(self.camera_num)
+        # RGB888 is stored as B, G, R like OpenCV expects it
+        config = self.camera.create_still_configuration(main={'format': 'RGB888'}, buffer_count=2)
+        self.camera.configure(config)
+        self.camera.start()
+        # auto exposure and white balance converge once per session
+        time.sleep(self.settle_time)
+
+    def close(self) -> None:
+        if self.camera is None:
+            return
+        self.camera.stop()
+        self.camera.close()
+        self.camera = None
+
+    def capture(self) -> np.ndarray:
+        """Captures a frame as BGR image"""
+        if self.camera is None:
+            raise RuntimeError('Camera is not open')
+        return self.camera.capture_array('main')
+
+
+class FakeCamera():
+    """
+    Camera without hardware that returns copies of a given image or a noisy
+    test pattern, e.g. for tests and benchmarks of the capture code.
+    """
+    persistent = True
+    exclusive = False
+    waits_for_axis = False
+
+    def __init__(self, image = None, width = 4056, height = 3040, capture_time = 0.0):
+        if image is None:
+            rng = np.random.default_rng(0)
+            noise = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+            image = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+        self.image = image
+        self.capture_time = capture_time
+        self.captured_frames = 0
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def capture(self) -> np.ndarray:
+        time.sleep(self.capture_time)
+        self.captured_frames += 1
+        return self.image.copy()
@@ -109,29 +109,31 @@ class Motor():
 
     def turn_right_for(self, steps) -> None:
         # turns the motor right for the given number of steps
-        self.pi.write(self.dir, self.__CLOCKWISE)
+        self.start_turn_right_for(steps)
+        self.wait_until_stopped()
 
-        max_steps_per_chain = 65_000
+    def turn_left_for(self, steps) -> None:
+        # turns the motor left for the given numer of steps
+        self.start_turn_left_for(steps)
+        self.wait_until_stopped()
 
-        number_of_chains = steps // max_steps_per_chain
-        modulo = steps % max_steps_per_chain
+    def start_turn_right_for(self, steps) -> float:
+        # starts turning the motor right for the given number of steps
+        # program doesn't wait while moving, returns the monotonic start time
+        self.pi.write(self.dir, self.__CLOCKWISE)
+        return self._send_steps(steps)
 
-        chain = []
-        x = max_steps_per_chain & 255
-        y = (max_steps_per_chain >> 8) #& 255
-        for i in range(number_of_chains):
-            chain += (255, 0, self.wave, 255, 1, x, y)
+    def start_turn_left_for(self, steps) -> float:
+        # starts turning the motor left for the given number of steps
+        # program doesn't wait while moving, returns the monotonic start time
+        self.pi.write(self.dir, self.__ANTI_CLOCKWISE)
+        return self._send_steps(steps)
 
-        x_1 = modulo & 255
-        y_1 = (modulo >> 8) #& 255
-        chain += (255, 0, self.wave, 255, 1, x_1, y_1)
-        self.pi.wave_chain(chain)
+    def wait_until_stopped(self, poll_interval = 0.1) -> None:
         while self.pi.wave_tx_busy():
-            time.sleep(0.1)
+            time.sleep(poll_interval)
 
-    def turn_left_for(self, steps) -> None:
-        # turns the motor left for the given numer of steps
-        self.pi.write(self.dir, self.__ANTI_CLOCKWISE)
+    def _send_steps(self, steps) -> float:
         max_steps_per_chain = 65_000
 
         number_of_chains = steps // max_steps_per_chain
@@ -147,8 +149,7 @@ class Motor():
         y_1 = (modulo >> 8) #& 255
         chain += (255, 0, self.wave, 255, 1, x_1, y_1)
         self.pi.wave_chain(chain)
-        while self.pi.wave_tx_busy():
-            time.sleep(0.1)
+        return time.monotonic()
     
     def change_speed(self, new_speed):
         delay = int((0.5 * 10**6)/new_speed)
@@ -164,7 +165,11 @@ class Motor():
         pulse.append(pigpio.pulse(1<<self.step, 0,       delay))
         pulse.append(pigpio.pulse(0,       1<<self.step, delay))
         self.pi.wave_add_generic(pulse)
+        old_wave = self.wave
         self.wave = self.pi.wave_create()
+        # pigpio only has a limited number of wave ids
+        self.pi.wave_delete(old_wave)
+        self.speed = new_speed
         
     def stop(self) -> None:
         # stops the motor when startet with turn_left or turn_right
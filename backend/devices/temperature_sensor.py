@@ -6,6 +6,7 @@ from time import sleep
 import logging
 import RPi.GPIO as GPIO
 import subprocess
+import Entomoscope.globals as globals
 
  
 class TemperaureSensor():
@@ -13,7 +14,7 @@ class TemperaureSensor():
     def __init__(self, temp_sensor_pin = 4):
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(temp_sensor_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        base_dir = '/sys/bus/w1/devices/'
+        base_dir = globals.W1_DEVICES_DIR
         num_tries = 0
         device_folder = None
         while num_tries < 3:
@@ -0,0 +1,240 @@
+"""
+Benchmark of the stacking pipeline on synthetic focal stacks.
+
+A sharp reference image is blurred depending on a synthetic depth map and the
+focal plane of every frame, drifted by a small translation/scale per frame and
+overlaid with sensor noise. Every stage of Stacking is run on it and wall
+time, peak RSS and a fidelity score against the ground truth are reported as
+JSON, so branches can be compared without the microscope.
+
+Run from the directory containing the Entomoscope package:
+
+    python -m Entomoscope.benchmarks.stacking_benchmark --width 4056 --height 3040 --frames 5 --output bench.json
+"""
+import argparse
+import gc
+import json
+import logging
+import resource
+import subprocess
+import time
+import typing
+import os
+
+import cv2
+import numpy
+
+from Entomoscope.frontend.controller.stacking import Stacking
+from Entomoscope.simulation.specimen import make_reference, make_depth
+
+STAGES = ['fusion', 'align', 'stacking']
+FUSION_MODES = ['classic', 'streaming', 'pyramid']
+ALIGNMENT_MODES = ['ecc', 'pyramid']
+# (alignment_strategy, alignment_mode, fusion_mode)
+STACKING_RUNS = [
+    ('chain', 'ecc', 'classic'),
+    ('chain', 'pyramid', 'streaming'),
+    ('reference', 'pyramid', 'streaming'),
+    ('chain', 'pyramid', 'pyramid'),
+]
+BLUR_LEVELS = 8
+
+
+def frame_warp(index: int, width: int, height: int, drift: float, scale_drift: float) -> numpy.ndarray:
+    """Forward warp from the reference to frame index: scale about the center plus translation"""
+    scale = 1 + index * scale_drift
+    warp = cv2.getRotationMatrix2D((width / 2, height / 2), 0, scale)
+    warp[:, 2] += index * drift
+    return warp
+
+
+def make_focal_stack(reference: numpy.ndarray,
+                     depth: numpy.ndarray,
+                     num_frames: int,
+                     max_blur: float,
+                     drift: float,
+                     scale_drift: float,
+                     noise: float,
+                     seed: int = 0,
+    ) -> typing.List[numpy.ndarray]:
+    """
+    Renders the frames of a focal stack. The focal plane of frame k is at
+    depth k / (num_frames - 1); the blur sigma grows linearly with the
+    distance to it up to max_blur.
+    """
+    rng = numpy.random.default_rng(seed)
+    height, width = reference.shape[:2]
+    frames = []
+    for k in range(num_frames):
+        focal_plane = k / max(num_frames - 1, 1)
+        blur_level = numpy.rint(numpy.abs(depth - focal_plane) * (BLUR_LEVELS - 1)).astype(numpy.uint8)
+        frame = numpy.empty_like(reference)
+        for level in range(BLUR_LEVELS):
+            sigma = max_blur * level / (BLUR_LEVELS - 1)
+            blurred = reference if sigma == 0 else cv2.GaussianBlur(reference, (0, 0), sigma)
+            numpy.copyto(frame, blurred, where=(blur_level == level)[..., None])
+        if drift or scale_drift:
+            warp = frame_warp(k, width, height, drift, scale_drift)
+            frame = cv2.warpAffine(frame, warp, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+        if noise:
+            noisy = frame.astype(numpy.float32) + rng.normal(0, noise, frame.shape).astype(numpy.float32)
+            frame = numpy.clip(noisy, 0, 255).astype(numpy.uint8)
+        frames.append(frame)
+    return frames
+
+
+def psnr(image: numpy.ndarray, truth: numpy.ndarray, margin: int) -> float:
+    """PSNR in dB, ignoring a border of margin pixels"""
+    a = image[margin:-margin or None, margin:-margin or None].astype(numpy.float32)
+    b = truth[margin:-margin or None, margin:-margin or None].astype(numpy.float32)
+    mse = float(numpy.mean((a - b) ** 2))
+    if mse == 0:
+        return float('inf')
+    return 10 * numpy.log10(255 ** 2 / mse)
+
+
+def _proc_status_mb(field: str) -> typing.Optional[float]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure(function: typing.Callable) -> typing.Tuple[typing.Any, dict]:
+    """Runs function and returns its result with wall time and peak RSS"""
+    gc.collect()
+    try:
+        # resets the peak RSS (VmHWM) of this process, Linux only
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    base_rss = _proc_status_mb('VmRSS')
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    peak_rss = _proc_status_mb('VmHWM')
+    if peak_rss is None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result, {'time_s': round(elapsed, 4), 'base_rss_mb': base_rss, 'peak_rss_mb': peak_rss}
+
+
+def bench_fusion(reference, depth, args) -> typing.List[dict]:
+    """Fusion only, on frames without drift, compared with the reference"""
+    frames = make_focal_stack(reference, depth, args.frames, args.max_blur, 0, 0, args.noise, args.seed)
+    results = []
+    for mode in FUSION_MODES:
+        stacking = Stacking()
+        if mode == 'classic':
+            function = lambda: stacking.focus_stack(frames)
+        elif mode == 'streaming':
+            function = lambda: stacking.focus_stack_streaming(iter(frames))
+        else:
+            function = lambda: stacking.focus_stack_pyramid(iter(frames))
+        stacked_image, stats = measure(function)
+        stats.update({'stage': f'fusion_{mode}', 'psnr_db': round(psnr(stacked_image, reference, args.margin), 3)})
+        results.append(stats)
+        del stacked_image
+    return results
+
+
+def bench_align(frames, args) -> typing.List[dict]:
+    """Warp estimation of every frame against the first one, compared with the true drift"""
+    height, width = frames[0].shape[:2]
+    center = numpy.array([width / 2, height / 2, 1])
+    grays = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
+    true_shifts = [frame_warp(k, width, height, args.drift, args.scale_drift) @ center - center for k in range(len(frames))]
+    results = []
+    for mode in ALIGNMENT_MODES:
+        stacking = Stacking()
+        function = lambda: [stacking.find_warp(grays[0], gray, mode)[0] for gray in grays[1:]]
+        warps, stats = measure(function)
+        errors = [float(numpy.linalg.norm(warp[:, 2] - true_shift)) for warp, true_shift in zip(warps, true_shifts[1:])]
+        stats.update({'stage': f'align_{mode}', 'pairs': len(warps), 'mean_warp_error_px': round(float(numpy.mean(errors)), 4)})
+        results.append(stats)
+    return results
+
+
+def bench_stacking(reference, frames, args) -> typing.List[dict]:
+    """End to end do_stacking, compared with the reference in the coordinates of the reference frame"""
+    height, width = reference.shape[:2]
+    results = []
+    for strategy, alignment_mode, fusion_mode in STACKING_RUNS:
+        reference_index = 0 if strategy == 'chain' else len(frames) // 2
+        truth = cv2.warpAffine(reference, frame_warp(reference_index, width, height, args.drift, args.scale_drift),
+                               (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+        stacking = Stacking()
+        function = lambda: stacking.do_stacking(iter(frames), fusion_mode=fusion_mode,
+                                                alignment_mode=alignment_mode, alignment_strategy=strategy)
+        stacked_image, stats = measure(function)
+        stats.update({
+            'stage': f'stacking_{strategy}_{alignment_mode}_{fusion_mode}',
+            'psnr_db': round(psnr(stacked_image, truth, args.margin), 3),
+        })
+        results.append(stats)
+        del stacked_image
+    return results
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the stacking pipeline on synthetic focal stacks')
+    parser.add_argument('--width', type=int, default=2028)
+    parser.add_argument('--height', type=int, default=1520)
+    parser.add_argument('--frames', type=int, default=5)
+    parser.add_argument('--max-blur', type=float, default=6.0, help='blur sigma at the largest defocus in pixels')
+    parser.add_argument('--drift', type=float, default=1.5, help='translation per frame in pixels')
+    parser.add_argument('--scale-drift', type=float, default=0.0, help='scale change per frame')
+    parser.add_argument('--noise', type=float, default=2.0, help='sensor noise sigma in gray values')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reference', help='sharp image to use instead of the synthetic specimen')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f'comma separated subset of {STAGES}')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.reference:
+        reference = cv2.imread(args.reference)
+        if reference is None:
+            parser.error(f'Could not read {args.reference}')
+        reference = cv2.resize(reference, (args.width, args.height), interpolation=cv2.INTER_AREA)
+    else:
+        reference = make_reference(args.width, args.height, args.seed)
+    depth = make_depth(args.width, args.height)
+    # the drifted border and the fusion kernels are not compared
+    args.margin = int(numpy.ceil(args.frames * (args.drift + args.scale_drift * max(args.width, args.height)))) + 8
+
+    stages = args.stages.split(',')
+    results = []
+    if 'fusion' in stages:
+        results += bench_fusion(reference, depth, args)
+    if 'align' in stages or 'stacking' in stages:
+        frames = make_focal_stack(reference, depth, args.frames, args.max_blur, args.drift, args.scale_drift, args.noise, args.seed)
+        if 'align' in stages:
+            results += bench_align(frames, args)
+        if 'stacking' in stages:
+            results += bench_stacking(reference, frames, args)
+
+    config = {key: value for key, value in vars(args).items() if key != 'output'}
+    report = {'benchmark': 'stacking', 'git_commit': git_commit(), 'config': config, 'results': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
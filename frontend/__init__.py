@@ -1,3 +1,16 @@
-from .ui import *
-from .video_widget import *
-from .controller import *
\ No newline at end of file
+import importlib
+
+# imported on first use, see the package __init__
+_SUBMODULES = ('ui', 'video_widget', 'controller', 'image_camera', 'focus_widget', 'focus_peaking')
+_REEXPORTED = ('ui', 'video_widget', 'controller')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if not name.startswith('_'):
+        for module_name in _REEXPORTED:
+            module = importlib.import_module(f'.{module_name}', __name__)
+            if name in vars(module):
+                return vars(module)[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
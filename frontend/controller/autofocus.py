@@ -0,0 +1,164 @@
+import logging
+import math
+import time
+import Entomoscope.globals as globals
+
+GOLDEN_RATIO = (1 + math.sqrt(5)) / 2
+
+
+class Autofocus:
+    """
+    Searches the position of the axis with the sharpest image. A coarse scan
+    upwards in AUTOFOCUS_COARSE_STEP steps finds the peak of the sharpness
+    curve and stops once it clearly rose above the start of the scan and
+    dropped behind the peak again. A golden section
+    search then narrows the interval around the peak down to
+    AUTOFOCUS_FINE_STEP. The axis ends at the best measured position. The
+    search stops refining once AUTOFOCUS_TIME_BUDGET is used up. Given a
+    predicted position, a finer scan of a narrow window around it replaces
+    the coarse scan of the whole axis.
+
+    :param measure:
+        returns the sharpness of the first frame taken after the monotonic
+        time passed, the time the last move was completed
+    :param measure_tiles:
+        optional, returns the sharpness of the tiles of the same frame, kept
+        in tile_measurements (e.g. for the StackBracketing)
+    """
+    def __init__(self, linear_axis, measure, time_budget=None, measure_tiles=None):
+        self.linear_axis = linear_axis
+        self.measure = measure
+        self.measure_tiles = measure_tiles
+        self.tile_measurements = {}
+        self.time_budget = globals.AUTOFOCUS_TIME_BUDGET if time_budget is None else time_budget
+        self.measurements = {}
+        self.moves = 0
+        self.start_time = None
+        # True if the last run ended at a clear peak within the time budget
+        self.peak_confirmed = False
+
+    def out_of_time(self):
+        return time.monotonic() - self.start_time > self.time_budget
+
+    def move_to(self, position):
+        if position != self.linear_axis.get_position():
+            if position < self.linear_axis.get_position() and globals.AUTOFOCUS_BACKLASH:
+                # positions are always approached from below
+                self.linear_axis.move_to(max(0, position - self.linear_axis.micrometer_to_mic_steps(globals.AUTOFOCUS_BACKLASH)), True)
+                self.moves += 1
+            self.linear_axis.move_to(position, True)
+            self.moves += 1
+
+    def sharpness_at(self, position):
+        """Sharpness at position in microsteps, measured once"""
+        if position not in self.measurements:
+            self.move_to(position)
+            self.measurements[position] = self.measure(self.linear_axis.last_move_time())
+            if self.measure_tiles is not None:
+                self.tile_measurements[position] = self.measure_tiles(self.linear_axis.last_move_time())
+        return self.measurements[position]
+
+    def coarse_scan(self, low, high, step):
+        """
+        Returns the best position of a scan from low to high. The scan ends
+        early after two readings clearly below a peak that clearly rose
+        above the first reading; a high first reading (e.g. a bright edge
+        or noise) can not end it, so the whole range is scanned then.
+        """
+        best_position = None
+        best_sharpness = None
+        first_sharpness = None
+        below_peak = 0
+        for position in range(low, high + 1, step):
+            sharpness = self.sharpness_at(position)
+            if first_sharpness is None:
+                first_sharpness = sharpness
+            if best_sharpness is None or sharpness > best_sharpness:
+                best_position, best_sharpness = position, sharpness
+                below_peak = 0
+            elif (sharpness < best_sharpness * globals.AUTOFOCUS_DROP_RATIO and
+                  first_sharpness < best_sharpness * globals.AUTOFOCUS_DROP_RATIO):
+                below_peak += 1
+                if below_peak >= 2:
+                    break
+            if self.out_of_time():
+                break
+        return best_position
+
+    def golden_section(self, low, high, min_interval):
+        """Narrows [low, high] around the peak of the sharpness"""
+        left = round(high - (high - low) / GOLDEN_RATIO)
+        right = round(low + (high - low) / GOLDEN_RATIO)
+        while high - low > min_interval and left < right and not self.out_of_time():
+            if self.sharpness_at(left) >= self.sharpness_at(right):
+                high = right
+                right = left
+                left = round(high - (high - low) / GOLDEN_RATIO)
+            else:
+                low = left
+                left = right
+                right = round(low + (high - low) / GOLDEN_RATIO)
+
+    def peak_found(self, peak, low, high):
+        """
+        True if the sharpness clearly dropped on both sides of peak within
+        [low, high] or the side is at the end of the axis
+        """
+        threshold = self.measurements[peak] * globals.AUTOFOCUS_DROP_RATIO
+        below = [sharpness for position, sharpness in self.measurements.items() if low <= position < peak]
+        above = [sharpness for position, sharpness in self.measurements.items() if peak < position <= high]
+        return ((low == 0 or any(sharpness < threshold for sharpness in below)) and
+                (high == self.linear_axis.highest_position() or any(sharpness < threshold for sharpness in above)))
+
+    def warm_scan(self, predicted, margin, step):
+        """
+        Scans around the predicted position, widening the window twice if no
+        peak is found. Returns the peak or None.
+        """
+        highest_position = self.linear_axis.highest_position()
+        for _ in range(3):
+            low, high = max(0, predicted - margin), min(highest_position, predicted + margin)
+            peak = self.coarse_scan(low, high, step)
+            if self.peak_found(peak, low, high):
+                return peak
+            if self.out_of_time() or (low == 0 and high == highest_position):
+                break
+            margin *= 2
+        return None
+
+    def run(self, predicted=None, margin=None):
+        """
+        Focuses and returns the best position in microsteps. With a predicted
+        position (e.g. from the FocusHistory) the search starts in a window
+        of +- margin microsteps around it and falls back to the scan of the
+        whole axis if no peak is found there. peak_confirmed tells if the
+        sharpness clearly dropped on both sides of the returned position
+        and the search finished within the time budget.
+        """
+        self.start_time = time.monotonic()
+        coarse_step = max(1, self.linear_axis.micrometer_to_mic_steps(globals.AUTOFOCUS_COARSE_STEP))
+        fine_step = max(1, self.linear_axis.micrometer_to_mic_steps(globals.AUTOFOCUS_FINE_STEP))
+        highest_position = self.linear_axis.highest_position()
+
+        peak = None
+        if predicted is not None:
+            step = max(1, self.linear_axis.micrometer_to_mic_steps(globals.AUTOFOCUS_WARM_STEP))
+            if margin is None:
+                margin = self.linear_axis.micrometer_to_mic_steps(globals.AUTOFOCUS_WARM_MARGIN)
+            peak = self.warm_scan(min(max(0, predicted), highest_position), max(margin, step), step)
+            if peak is None:
+                logging.info(f'No focus peak near the predicted position {predicted}, scanning the whole axis')
+        if peak is None and not self.out_of_time():
+            step = coarse_step
+            peak = self.coarse_scan(0, highest_position, step)
+        if peak is not None:
+            self.golden_section(max(0, peak - step), min(highest_position, peak + step), fine_step)
+
+        best_position = max(self.measurements, key=self.measurements.get)
+        self.peak_confirmed = (peak is not None and not self.out_of_time() and
+                               self.peak_found(best_position, 0, highest_position))
+        self.move_to(best_position)
+        logging.info(f'Autofocus at {best_position} (sharpness {self.measurements[best_position]:.1f}) after '
+                     f'{self.moves} moves and {len(self.measurements)} measurements in {time.monotonic() - self.start_time:.1f}s'
+                     f'{"" if self.peak_confirmed else ", no clear peak"}')
+        return best_position
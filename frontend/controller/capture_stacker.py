@@ -0,0 +1,83 @@
+from threading import Thread
+from queue import Queue
+import itertools
+import logging
+import os
+import time
+import cv2
+from Entomoscope.frontend.controller.stacking import Stacking
+import Entomoscope.globals as globals
+
+
+class CaptureStacker(Thread):
+    """
+    Fuses one stack while it is still being taken. Every frame handed over
+    with add_frame is aligned and folded into the running result right away,
+    so the stacked image is written shortly after the last frame. The
+    offline Stacker skips the stack while this thread owns it and gets it
+    as job if the stacking here fails.
+    """
+    def __init__(self, stack_dir, stacked_img_name, stack_info, stacker):
+        super(CaptureStacker, self).__init__()
+        self.stack_dir = os.path.normpath(stack_dir)
+        self.stacked_img_name = stacked_img_name
+        self.stack_info = stack_info
+        self.stacker = stacker
+        self.stacking_algorithm = Stacking()
+        self.frames = Queue()
+        self.last_frame_time = None
+        self.stacker.in_progress.add(self.stack_dir)
+
+    def add_frame(self, frame):
+        """Hands over a frame as image or as path of the written image"""
+        self.frames.put(frame)
+
+    def finish(self):
+        """Signals that the last frame of the stack was added"""
+        self.frames.put(None)
+
+    def _frames(self):
+        for frame in iter(self.frames.get, None):
+            if isinstance(frame, str):
+                frame = cv2.imread(frame)
+            if frame is None:
+                logging.error(f'Could not read frame for {self.stacked_img_name}')
+                continue
+            self.last_frame_time = time.time()
+            yield frame
+
+    def run(self):
+        written = False
+        try:
+            frames = self._frames()
+            first_frames = list(itertools.islice(frames, 2))
+            if len(first_frames) == 0:
+                logging.error(f'No frames to stack for {self.stacked_img_name}')
+                return
+            if len(first_frames) == 1:
+                stacked_image = first_frames[0]
+            else:
+                # only the chained alignment and the streaming or pyramid
+                # fusion work frame by frame
+                fusion_mode = globals.FUSION_MODE if globals.FUSION_MODE != 'classic' else 'streaming'
+                stacked_image = self.stacker.warp_cache.do_stacking(
+                    self.stacking_algorithm,
+                    itertools.chain(first_frames, frames),
+                    self.stack_info,
+                    fusion_mode=fusion_mode,
+                    alignment_strategy='chain',
+                )
+            depth_map_futures = []
+            if len(first_frames) > 1 and globals.SAVE_DEPTH_MAP:
+                depth_map_futures.append(self.stacker.output_writer.submit(self.stacking_algorithm.write_depth_map, self.stacked_img_name))
+            self.stacker.output_writer.write_all(self.stacked_img_name, stacked_image, *depth_map_futures)
+            written = True
+            self.stacker.mark_done(self.stack_dir, self.stacked_img_name)
+            logging.info(f'Wrote stacked Image {self.stacked_img_name} '
+                         f'{time.time() - self.last_frame_time:.2f}s after the last frame')
+        except Exception as e:
+            logging.error(f'Stacking while capturing failed for {self.stacked_img_name}: {e}')
+        finally:
+            self.stacker.in_progress.discard(self.stack_dir)
+            if not written:
+                self.stacker.add_job(self.stack_dir)
@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+import statistics
+import typing
+
+import Entomoscope.globals as globals
+
+
+class FocusHistory:
+    """
+    Persistent history of the positions the autofocus found, per profile
+    (pin holder and lens, see FOCUS_PROFILE) and microstep resolution.
+    Specimens on the same holder sit within a narrow band of heights, so the
+    median of the latest positions predicts the next one. Positions found
+    in this session are preferred over the persisted ones.
+    """
+
+    def __init__(self, path: str = globals.FOCUS_HISTORY_PATH, size: int = globals.FOCUS_HISTORY_SIZE) -> None:
+        self.path = path
+        self.size = size
+        self.positions = {}
+        self.session_positions = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.positions = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Could not read focus history {path}: {e}')
+
+    def _key(self, profile, mic_resolution) -> str:
+        return f'{profile}:{mic_resolution}'
+
+    def predict(self, profile, mic_resolution) -> typing.Optional[int]:
+        """Predicted focus position in microsteps or None without history"""
+        key = self._key(profile, mic_resolution)
+        positions = self.session_positions.get(key) or self.positions.get(key)
+        if not positions:
+            return None
+        return round(statistics.median(positions))
+
+    def spread(self, profile, mic_resolution) -> int:
+        """Range of the positions the prediction is based on in microsteps"""
+        key = self._key(profile, mic_resolution)
+        positions = self.session_positions.get(key) or self.positions.get(key)
+        if not positions:
+            return 0
+        return max(positions) - min(positions)
+
+    def add(self, profile, mic_resolution, position) -> None:
+        """Adds a focus position in microsteps and saves the history"""
+        key = self._key(profile, mic_resolution)
+        for positions in (self.session_positions, self.positions):
+            positions[key] = (positions.get(key, []) + [int(position)])[-self.size:]
+        self.save()
+
+    def save(self) -> None:
+        """Writes the history to a temporary file and renames it atomically"""
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.positions, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f'Could not write focus history {self.path}: {e}')
@@ -0,0 +1,85 @@
+from threading import Thread
+from queue import Queue
+import logging
+import time
+import cv2
+import Entomoscope.globals as globals
+
+
+class StackAcquisition:
+    """
+    Takes the frames of a stack as a pipeline. The calling thread captures a
+    frame, hands it to the writer threads through a bounded queue and moves
+    the axis to the next position right away, while the previous frames are
+    encoded and written. The queue holds at most
+    STACK_ACQUISITION_QUEUE_SIZE frames, so a slow disk blocks the capture
+    instead of filling the memory. on_frame gets every frame in order after
+    it was captured (e.g. CaptureStacker.add_frame).
+    """
+    def __init__(self, image_camera, linear_axis, step_size, on_frame=None, writers=None, queue_size=None):
+        self.image_camera = image_camera
+        self.linear_axis = linear_axis
+        self.step_size = step_size
+        self.on_frame = on_frame
+        self.writers = writers or globals.STACK_ACQUISITION_WRITERS
+        self.frames = Queue(maxsize=queue_size or globals.STACK_ACQUISITION_QUEUE_SIZE)
+        self.written = []
+        self.timings = []
+
+    def _write_frames(self):
+        for image_path, image in iter(self.frames.get, None):
+            try:
+                if self.image_camera.save_image(image_path, image):
+                    self.written.append(image_path)
+                else:
+                    logging.error(f'Could not encode image at path: {image_path}')
+            except OSError as e:
+                logging.error(f'Could not write image at path: {image_path}: {e}')
+
+    def _capture(self, image_path):
+        """Takes a frame; a frame of a non persistent backend is written right away"""
+        if self.image_camera.backend.persistent:
+            return self.image_camera.capture()
+        if not self.image_camera.take_image(image_path):
+            return None
+        self.written.append(image_path)
+        return cv2.imread(image_path) if self.on_frame is not None else None
+
+    def run(self, image_paths):
+        """
+        Takes one frame for every path, moving the axis up by step_size in
+        between, and returns the paths of the written frames once all of them
+        are on disk.
+        """
+        writer_threads = [Thread(target=self._write_frames) for _ in range(self.writers)]
+        for thread in writer_threads:
+            thread.start()
+        start = time.time()
+        try:
+            with self.image_camera.session():
+                for i, image_path in enumerate(image_paths):
+                    capture_start = time.time()
+                    image = self._capture(image_path)
+                    capture_end = time.time()
+                    if image is not None:
+                        if self.image_camera.backend.persistent:
+                            # blocks while the writers are behind
+                            self.frames.put((image_path, image))
+                        if self.on_frame is not None:
+                            self.on_frame(image)
+                    if i < len(image_paths) - 1:
+                        self.linear_axis.move_up_for(self.step_size)
+                        if not self.image_camera.backend.waits_for_axis:
+                            time.sleep(globals.STACK_SETTLE_TIME)
+                    self.timings.append((capture_end - capture_start, time.time() - capture_end))
+        finally:
+            for _ in writer_threads:
+                self.frames.put(None)
+            for thread in writer_threads:
+                thread.join()
+        if self.timings:
+            capture_time = sum(timing[0] for timing in self.timings) / len(self.timings)
+            move_time = sum(timing[1] for timing in self.timings) / len(self.timings)
+            logging.info(f'Took {len(self.written)} of {len(image_paths)} frames in {time.time() - start:.2f}s '
+                         f'(capture {capture_time:.2f}s, move {move_time:.2f}s per frame)')
+        return sorted(self.written)
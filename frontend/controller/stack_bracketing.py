@@ -0,0 +1,104 @@
+import logging
+import math
+import typing
+import Entomoscope.globals as globals
+
+
+def depth_of_field(numerical_aperture, magnification, pixel_size, wavelength=0.55, refractive_index=1.0) -> float:
+    """
+    Depth of field in micrometers as the sum of the diffraction limited and
+    the geometrical term of the sensor pixel (all lengths in micrometers).
+    """
+    return (wavelength * refractive_index / numerical_aperture ** 2 +
+            refractive_index * pixel_size / (magnification * numerical_aperture))
+
+
+def peak_position(profile) -> float:
+    """
+    Position of the maximum of profile, a list of (position, sharpness)
+    ascending in position, refined by the vertex of the parabola through the
+    maximum and its neighbours.
+    """
+    i = max(range(len(profile)), key=lambda i: profile[i][1])
+    if i == 0 or i == len(profile) - 1:
+        return profile[i][0]
+    (x0, y0), (x1, y1), (x2, y2) = profile[i - 1:i + 2]
+    denominator = (x0 - x1) * (x0 - x2) * (x1 - x2)
+    a = (x2 * (y1 - y0) + x1 * (y0 - y2) + x0 * (y2 - y1)) / denominator
+    b = (x2 ** 2 * (y0 - y1) + x1 ** 2 * (y2 - y0) + x0 ** 2 * (y1 - y2)) / denominator
+    if a >= 0:
+        return x1
+    return min(max(-b / (2 * a), x0), x2)
+
+
+def has_content(profile) -> bool:
+    """True if the sharpness of profile varies enough to contain a focused structure"""
+    values = [sharpness for _, sharpness in profile]
+    return min(values) > 0 and max(values) / min(values) >= globals.BRACKETING_MIN_CONTRAST
+
+
+class StackBracketing:
+    """
+    Derives the focal planes of a stack from the sharpness measured by the
+    autofocus. The peak of every tile of the frame with enough contrast
+    (and of the whole frame) is the height a part of the specimen is in
+    focus at; the planes cover the range of these peaks, spaced by the depth
+    of field of the optics times BRACKETING_OVERLAP.
+    """
+    def __init__(self, linear_axis):
+        self.linear_axis = linear_axis
+
+    def step_size(self) -> int:
+        """Distance of the planes in micrometers, within the step sizes of a stack"""
+        dof = depth_of_field(globals.OPTICS_NUMERICAL_APERTURE, globals.OPTICS_MAGNIFICATION,
+                             globals.OPTICS_PIXEL_SIZE, globals.OPTICS_WAVELENGTH, globals.OPTICS_REFRACTIVE_INDEX)
+        return min(max(1, globals.MIN_STACK_STEP_SIZE, round(dof * globals.BRACKETING_OVERLAP)), globals.MAX_STACK_STEP_SIZE)
+
+    def focus_range(self, measurements, tile_measurements) -> typing.Optional[typing.Tuple[float, float]]:
+        """
+        Lowest and highest position in microsteps a part of the specimen is
+        in focus at, or None without enough measurements.
+
+        :param measurements:
+            dict of position to sharpness of the whole frame
+        :param tile_measurements:
+            dict of position to the sharpness of the tiles as list of rows
+        """
+        if len(measurements) < 3:
+            return None
+        peaks = [peak_position(sorted(measurements.items()))]
+        positions = sorted(position for position, tiles in tile_measurements.items() if tiles is not None)
+        if len(positions) >= 3:
+            rows = tile_measurements[positions[0]]
+            for row in range(len(rows)):
+                for column in range(len(rows[row])):
+                    profile = [(position, tile_measurements[position][row][column]) for position in positions]
+                    if has_content(profile):
+                        peaks.append(peak_position(profile))
+        return min(peaks), max(peaks)
+
+    def planes(self, measurements, tile_measurements) -> typing.Optional[typing.Tuple[int, int, int]]:
+        """
+        Returns (position of the lowest plane in microsteps, step size in
+        micrometers, number of planes) of the smallest stack covering the
+        focus range, or None if it can not be determined. The step size and
+        the number of planes are within MIN_/MAX_STACK_STEP_SIZE and
+        MIN_/MAX_NUM_OF_STACKS.
+        """
+        focus_range = self.focus_range(measurements, tile_measurements)
+        if focus_range is None:
+            return None
+        step_size = self.step_size()
+        step_mic_steps = self.linear_axis.micrometer_to_mic_steps(step_size)
+        low, high = focus_range
+        num_planes = max(globals.MIN_NUM_OF_STACKS, math.ceil((high - low) / step_mic_steps) + 1)
+        if num_planes > globals.MAX_NUM_OF_STACKS:
+            logging.warning(f'Focus range of {self.linear_axis.mic_steps_to_micrometer(high - low)}um needs '
+                            f'{num_planes} planes, taking the central {globals.MAX_NUM_OF_STACKS}')
+            num_planes = globals.MAX_NUM_OF_STACKS
+        # the planes are centered on the focus range
+        start = round((low + high) / 2 - (num_planes - 1) * step_mic_steps / 2)
+        start = min(max(0, start), self.linear_axis.highest_position() - (num_planes - 1) * step_mic_steps)
+        logging.info(f'Bracketed stack of {num_planes} planes {step_size}um apart from {start} '
+                     f'(in focus from {low:.0f} to {high:.0f})')
+        return max(0, start), step_size, num_planes
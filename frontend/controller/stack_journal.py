@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from threading import Lock
+
+import Entomoscope.globals as globals
+
+
+class StackJournal:
+    """
+    Persistent journal of the stacking jobs of one working dir, kept in an
+    SQLite file inside it. Every stack dir has a state (pending, running,
+    done, failed), its input files with a fingerprint, and the output path.
+    Each update is one transaction, so the journal stays consistent when
+    the program stops at any point.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, working_dir):
+        self.path = os.path.join(working_dir, globals.STACK_JOURNAL_FILE_NAME)
+        self.lock = Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS stacks ('
+                'stack_dir TEXT PRIMARY KEY, state TEXT NOT NULL, inputs TEXT, '
+                'fingerprint TEXT, output TEXT, error TEXT, updated REAL)'
+            )
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def fingerprint(self, paths):
+        """Fingerprint of the input files from their names, sizes and modification times"""
+        digest = hashlib.sha1()
+        for path in sorted(paths):
+            stat = os.stat(path)
+            digest.update(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+        return digest.hexdigest()
+
+    def get(self, stack_dir):
+        """Returns the entry of a stack dir as dict or None"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT state, inputs, fingerprint, output, error, updated FROM stacks WHERE stack_dir = ?',
+                (stack_dir,),
+            ).fetchone()
+        if row is None:
+            return None
+        state, inputs, fingerprint, output, error, updated = row
+        return {
+            'state': state,
+            'inputs': json.loads(inputs) if inputs else [],
+            'fingerprint': fingerprint,
+            'output': output,
+            'error': error,
+            'updated': updated,
+        }
+
+    def set_state(self, stack_dir, state, inputs=None, fingerprint=None, output=None, error=None):
+        """Sets the state of a stack dir, the other fields are only changed if given"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO stacks (stack_dir, state, inputs, fingerprint, output, error, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(stack_dir) DO UPDATE SET state = excluded.state, '
+                'inputs = COALESCE(excluded.inputs, inputs), '
+                'fingerprint = COALESCE(excluded.fingerprint, fingerprint), '
+                'output = COALESCE(excluded.output, output), '
+                'error = excluded.error, updated = excluded.updated',
+                (stack_dir, state, json.dumps(inputs) if inputs is not None else None,
+                 fingerprint, output, error, time.time()),
+            )
+
+    def stack_dirs(self, *states):
+        """Returns the stack dirs in one of the given states"""
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT stack_dir FROM stacks WHERE state IN ({",".join("?" * len(states))})',
+                states,
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def reset_running(self):
+        """Jobs that were running when the program stopped are pending again"""
+        with self.lock, self.connection:
+            count = self.connection.execute(
+                'UPDATE stacks SET state = ? WHERE state = ?', (self.PENDING, self.RUNNING)
+            ).rowcount
+        if count:
+            logging.info(f'Resuming {count} interrupted stacking jobs')
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (key, str(value)),
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
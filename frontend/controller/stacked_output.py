@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import cv2
+import Entomoscope.globals as globals
+from Entomoscope.utils.write_image_atomic import write_image_atomic
+
+
+def encode_options(output):
+    """
+    Extension and cv2.imencode parameters of an output description from
+    globals (format png, webp, tiff or jpg and its options).
+    """
+    image_format = output['format']
+    if image_format == 'png':
+        return '.png', [cv2.IMWRITE_PNG_COMPRESSION, output.get('level', 1)]
+    if image_format == 'webp':
+        # quality above 100 is lossless
+        return '.webp', [cv2.IMWRITE_WEBP_QUALITY, 101 if output.get('lossless', True) else output.get('quality', 90)]
+    if image_format == 'tiff':
+        # 1 none, 5 LZW, 8 Deflate
+        return '.tiff', [cv2.IMWRITE_TIFF_COMPRESSION, output.get('compression', 5)]
+    if image_format == 'jpg':
+        return '.jpg', [cv2.IMWRITE_JPEG_QUALITY, output.get('quality', 95)]
+    raise ValueError(f'Unknown output format {image_format}')
+
+
+def fit_size(image, max_size):
+    """Image scaled down so its longer side is at most max_size"""
+    if max_size is None:
+        return image
+    height, width = image.shape[:2]
+    scale = max_size / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+class StackedOutputWriter:
+    """
+    Writes a stacked image and its derivatives (globals.STACKED_DERIVATIVES,
+    e.g. a lossless archive copy, a preview and a thumbnail) from the image
+    in memory. Every file is encoded and written in a thread of a pool and
+    renamed into place atomically. The smaller derivatives are scaled from
+    the next bigger one, so the full image is only scaled once.
+    """
+    def __init__(self, workers=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers or globals.OUTPUT_WRITER_WORKERS)
+
+    def derivative_name(self, stacked_img_name, output):
+        """Stacked_<name>.png -> <prefix><name><extension>"""
+        directory, name = os.path.split(stacked_img_name)
+        extension, _ = encode_options(output)
+        stem = os.path.splitext(name)[0].replace('Stacked_', '', 1)
+        return os.path.join(directory, f'{output["prefix"]}{stem}{extension}')
+
+    def submit(self, function, *args):
+        return self.pool.submit(function, *args)
+
+    def write(self, stacked_img_name, stacked_image):
+        """
+        Starts writing the stacked image and its derivatives.
+
+        :return: list of (path, future) with the result of write_image_atomic
+        """
+        _, params = encode_options({'format': 'png', 'level': globals.STACKED_IMAGE_PNG_LEVEL})
+        futures = [(stacked_img_name, self.pool.submit(write_image_atomic, stacked_img_name, stacked_image, params))]
+        image = stacked_image
+        for output in sorted(globals.STACKED_DERIVATIVES, key=lambda output: -(output.get('max_size') or float('inf'))):
+            if output.get('max_size') is not None:
+                image = fit_size(image, output['max_size'])
+            path = self.derivative_name(stacked_img_name, output)
+            _, params = encode_options(output)
+            futures.append((path, self.pool.submit(write_image_atomic, path, image, params)))
+        return futures
+
+    def write_all(self, stacked_img_name, stacked_image, *extra_futures):
+        """
+        Writes the stacked image and its derivatives and waits for them and
+        extra_futures. Raises IOError if the stacked image could not be
+        written, a failed derivative is only logged.
+        """
+        futures = self.write(stacked_img_name, stacked_image)
+        for future in extra_futures:
+            future.result()
+        for path, future in futures[1:]:
+            try:
+                if not future.result():
+                    logging.error(f'Could not encode {path}')
+            except OSError as e:
+                logging.error(f'Could not write {path}: {e}')
+        if not futures[0][1].result():
+            raise IOError(f'Could not encode {stacked_img_name}')
+
+    def shutdown(self):
+        self.pool.shutdown()
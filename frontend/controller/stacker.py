@@ -1,63 +1,425 @@
-from threading import Thread
+from threading import Thread, Condition
 import logging
-from gpiozero import CPUTemperature
 import time
-from Entomoscope.frontend.controller.stacking import Stacking
+from Entomoscope.frontend.controller.stacking_job import run_stacking_job
+from Entomoscope.frontend.controller.warp_cache import WarpCache
+from Entomoscope.frontend.controller.stack_journal import StackJournal
+from Entomoscope.frontend.controller.stacked_output import StackedOutputWriter
+from Entomoscope.frontend.controller.thermal_governor import ThermalGovernor
 import Entomoscope.globals as globals
-import Entomoscope.backend.configuration as configuration
-from Entomoscope.backend.devices.fan import Fan
-from Entomoscope.backend.devices.temperature_sensor import TemperaureSensor
 from glob import glob
 import os
 from pathlib import Path
 import cv2
+import json
+import re
 import shutil
+import sqlite3
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from concurrent.futures.process import BrokenProcessPool
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+
+def stacked_img_name(stack_dir, reduction=1):
+    """
+    <specimen folder>/RAW_Data/<stack> -> <specimen folder>/Stacked_<stack>.png,
+    or Stacked_<stack>_r<reduction>.png for a stack fused at 1/reduction of
+    the resolution, so it is never taken for a full resolution output
+    """
+    folder = os.path.dirname(os.path.dirname(os.path.normpath(stack_dir)))
+    suffix = '' if reduction == 1 else f'_r{reduction}'
+    return f'{folder}/Stacked_{os.path.basename(os.path.normpath(stack_dir))}{suffix}.png'
+
+
+def stack_name(stacked_img_name):
+    """Stacked_<stack>.png or Stacked_<stack>_r<reduction>.png -> <stack>"""
+    name = os.path.splitext(os.path.basename(stacked_img_name))[0].replace('Stacked_', '', 1)
+    return re.sub(r'_r[0-9]+$', '', name)
 
 class Stacker(Thread):
-    def __init__(self,working_dir):
+    """
+    Schedules the fusion of stacks in the background. Stacks are handed over
+    as jobs by the capture code (add_job) and by a watchdog observer for data
+    added from outside; the thread sleeps while there is nothing to do. The
+    jobs run in a process pool, stacks of the specimen selected in the UI
+    first, the backlog afterwards. A ThermalGovernor limits how many of them
+    run at once while the Pi or the enclosure is hot (temp_sensor, e.g. the
+    one of the FanController, is handed to it). The state of every job is kept in a
+    StackJournal in the working dir, so interrupted jobs are redone after a
+    restart. A scan for stacks that were never fused only looks at stack
+    dirs with files changed since the journal was last in sync, or at the
+    whole tree if the last run did not stop cleanly.
+    """
+    def __init__(self,working_dir, workers=None, temp_sensor=None):
         super(Stacker, self).__init__()
         self.working_dir = working_dir
+        self.working_dir_changed = False
         self.interrupted = False
-        self.stacking_algorithm = Stacking()
+        self.workers = workers or globals.STACKER_WORKERS or os.cpu_count() or 1
+        self.pool = None
+        self.warp_cache = WarpCache()
+        # writes the results of the CaptureStackers, the workers have their own
+        self.output_writer = StackedOutputWriter()
+        self.journal = None
+        # stacks that are fused while they are taken (see CaptureStacker)
+        self.in_progress = set()
+        # stack dir -> time from which on it may be stacked
+        self.jobs = {}
+        # stack dir -> time it was queued first
+        self.queued_at = {}
+        # stack dir -> time it was handed to the pool
+        self.running = {}
+        self.jobs_changed = Condition()
+        self.governor = ThermalGovernor(self.workers, self.thermal_state_changed, temp_sensor)
+        self.priority_folder = None
+        # (finish time, latency, duration) of the finished jobs
+        self.finished_jobs = deque(maxlen=1000)
+        self.observer = None
 
     def run(self):
-        logging.info(f'Starting stacking')
+        logging.info(f'Starting stacking with {self.workers} workers')
+        self.governor.start()
+        self.open_working_dir()
         while not self.interrupted:
-            candidates = []
-            working_dir = glob(os.path.join(self.working_dir,'*'))
-            for dirr in working_dir:
-                foldersSelectedDirectory = glob(os.path.join(dirr, globals.SPECIMENS_PREFIX + '*'))
-                for folder in foldersSelectedDirectory:
-                    curr = [x[0] for x in os.walk(os.path.join(folder,globals.RAW_DATA_DIR_NAME))]
-                    for cur in curr:
-                        if not cur.split('/')[-1] == globals.RAW_DATA_DIR_NAME:
-                            candidates.append([folder,cur])
-            for candidate in candidates:
-                if len(os.listdir(candidate[1])) > 1:
-                    folder, stack_dir = candidate
-                    stacked_img_name = f'{folder}/Stacked_{stack_dir.split("/")[-1]}.png'
-                    if os.path.exists(stacked_img_name) and Path(stacked_img_name).is_file():
-                        continue
-                    # do stacking
-                    if os.listdir(stack_dir):
-                        image_names = os.listdir(stack_dir)
-                        individual_image_paths = []
-                        for i in range (0, len(image_names)):
-                            individual_image_paths.append(os.path.join(stack_dir, image_names[i]))
-                        individual_images = []
-                        for image_path in individual_image_paths:
-                            individual_images.append(cv2.imread(image_path))
-                        if len(individual_images) > 1:
-                            stacked_image = self.stacking_algorithm.do_stacking(individual_images)
-                        else:
-                            stacked_image = individual_images[0]
-                        cv2.imwrite(stacked_img_name,stacked_image)
-                        logging.info(f'Wrote stacked Image {stacked_img_name}')
-
+            if self.working_dir_changed:
+                self.close_working_dir()
+                self.open_working_dir()
+            stack_dir = self.next_job()
+            if stack_dir is None:
+                continue
+            try:
+                self.submit(stack_dir)
+            except Exception as e:
+                logging.error(f'Stacking of {stack_dir} failed: {e}')
+                self.job_finished(stack_dir)
+        self.close_working_dir()
+        self.governor.interrupt()
+        self.output_writer.shutdown()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
         logging.info(f'Stopped stacking')
 
+    def open_working_dir(self):
+        """Opens the journal of the working dir, resumes its jobs and watches it"""
+        self.working_dir_changed = False
+        with self.jobs_changed:
+            self.jobs.clear()
+            self.queued_at.clear()
+        try:
+            self.journal = StackJournal(self.working_dir)
+        except sqlite3.Error as e:
+            logging.error(f'Could not open stacking journal in {self.working_dir}: {e}')
+            self.journal = None
+        self.watch(self.working_dir)
+
+        scan_start = time.time()
+        if self.journal is None:
+            self.scan()
+        else:
+            self.journal.reset_running()
+            last_sync = self.journal.get_meta('last_sync')
+            if self.journal.get_meta('clean') == '1' and last_sync is not None:
+                self.scan(since=float(last_sync))
+            else:
+                self.scan()
+            self.journal.set_meta('clean', 0)
+            self.journal.set_meta('last_sync', scan_start)
+            for stack_dir in self.journal.stack_dirs(StackJournal.PENDING):
+                self.add_job(stack_dir)
+
+    def close_working_dir(self):
+        self.stop_watching()
+        if self.journal is not None:
+            # the watcher was active until now, so nothing was missed
+            self.journal.set_meta('last_sync', time.time())
+            if not self.running:
+                self.journal.set_meta('clean', 1)
+            self.journal.close()
+            self.journal = None
+
+    def add_job(self, stack_dir, delay=0):
+        """
+        Queues a stack dir. A job that is already queued is postponed, so
+        files that are still being written are waited for.
+        """
+        stack_dir = os.path.normpath(stack_dir)
+        with self.jobs_changed:
+            self.jobs[stack_dir] = time.time() + delay
+            self.queued_at.setdefault(stack_dir, time.time())
+            self.jobs_changed.notify()
+
+    def set_priority_folder(self, folder):
+        """Stacks inside folder (the current specimen) are fused before all others"""
+        with self.jobs_changed:
+            self.priority_folder = os.path.normpath(folder) if folder is not None else None
+            self.jobs_changed.notify()
+
+    def job_priority(self, stack_dir, due):
+        if self.priority_folder is not None and stack_dir.startswith(self.priority_folder + os.sep):
+            return (0, due)
+        return (1, due)
+
+    def next_job(self):
+        """
+        Blocks until a job is due and the ThermalGovernor admits another
+        one, the working dir
+        changed or the stacker is interrupted. Returns the due job with the
+        highest priority.
+        """
+        with self.jobs_changed:
+            while not self.interrupted and not self.working_dir_changed:
+                now = time.time()
+                waiting = [(stack_dir, due) for stack_dir, due in self.jobs.items() if stack_dir not in self.running]
+                due_jobs = [(stack_dir, due) for stack_dir, due in waiting if due <= now]
+                if due_jobs and len(self.running) < self.governor.allowed_workers:
+                    stack_dir, _ = min(due_jobs, key=lambda job: self.job_priority(*job))
+                    del self.jobs[stack_dir]
+                    return stack_dir
+                if waiting and not due_jobs:
+                    self.jobs_changed.wait(min(due for _, due in waiting) - now)
+                else:
+                    self.jobs_changed.wait()
+        return None
+
+    def get_pool(self):
+        """The process pool, created on first use and after it broke"""
+        with self.jobs_changed:
+            if self.pool is None:
+                # spawned workers only import the stacking modules, the package
+                # __init__s are lazy (see utils/check_worker_imports.py)
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def discard_pool(self, pool):
+        """Shuts down a broken pool, the next job creates a new one"""
+        with self.jobs_changed:
+            if self.pool is pool:
+                self.pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def thermal_state_changed(self, allowed_workers):
+        with self.jobs_changed:
+            self.jobs_changed.notify()
+
+    def scan(self, since=None):
+        """
+        Queues all stacks in the working dir that are not stacked. If since
+        is given, only stack dirs with a file modified after it are looked at.
+        """
+        working_dir = glob(os.path.join(self.working_dir,'*'))
+        for dirr in working_dir:
+            foldersSelectedDirectory = glob(os.path.join(dirr, globals.SPECIMENS_PREFIX + '*'))
+            for folder in foldersSelectedDirectory:
+                raw_data_dir = os.path.join(folder,globals.RAW_DATA_DIR_NAME)
+                curr = [x[0] for x in os.walk(raw_data_dir)]
+                for cur in curr:
+                    if not cur.split('/')[-1] == globals.RAW_DATA_DIR_NAME:
+                        if since is not None and self.last_modified(cur) <= since:
+                            continue
+                        entry = self.journal.get(os.path.normpath(cur)) if self.journal is not None else None
+                        if self.existing_output(cur) is None or (entry is not None and entry['state'] != StackJournal.DONE):
+                            self.add_job(cur)
+
+    def last_modified(self, stack_dir):
+        """
+        Latest modification time of a stack dir and its files. Images
+        replaced in place do not change the time of the dir itself.
+        """
+        try:
+            with os.scandir(stack_dir) as entries:
+                return max([os.path.getmtime(stack_dir)] +
+                           [entry.stat().st_mtime for entry in entries if entry.is_file()])
+        except OSError:
+            # gone or unreadable, looked at by the caller
+            return float('inf')
+
+    def stacked_img_name(self, stack_dir):
+        """Output of the stacks fused here, at 1/STACKING_DECODE_REDUCTION of the resolution"""
+        return stacked_img_name(stack_dir, globals.STACKING_DECODE_REDUCTION)
+
+    def existing_output(self, stack_dir):
+        """
+        Path of the stacked image of a stack or None. A full resolution output
+        (e.g. of a CaptureStacker) also counts for reduced stacking.
+        """
+        for path in dict.fromkeys((stacked_img_name(stack_dir), self.stacked_img_name(stack_dir))):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def stack_image_paths(self, stack_dir):
+        image_names = sorted(x for x in os.listdir(stack_dir) if x.endswith('.png'))
+        return [os.path.join(stack_dir, image_name) for image_name in image_names]
+
+    def mark_done(self, stack_dir, stacked_img_name):
+        """Records a stack that was fused elsewhere (see CaptureStacker) as done"""
+        if self.journal is None:
+            return
+        stack_dir = os.path.normpath(stack_dir)
+        individual_image_paths = self.stack_image_paths(stack_dir)
+        self.journal.set_state(stack_dir, StackJournal.DONE, individual_image_paths,
+                               self.journal.fingerprint(individual_image_paths), stacked_img_name)
+
+    def submit(self, stack_dir):
+        """Hands a stack to the process pool unless it is already stacked"""
+        if stack_dir in self.in_progress or not os.path.isdir(stack_dir):
+            self.job_finished(stack_dir)
+            return
+        stacked_img_name = self.stacked_img_name(stack_dir)
+        individual_image_paths = self.stack_image_paths(stack_dir)
+        if len(individual_image_paths) < 2:
+            self.job_finished(stack_dir)
+            return
+        journal = self.journal
+        if journal is not None:
+            fingerprint = journal.fingerprint(individual_image_paths)
+            entry = journal.get(stack_dir)
+            existing_output = self.existing_output(stack_dir)
+            if existing_output is not None:
+                if entry is None:
+                    # stacked before there was a journal
+                    journal.set_state(stack_dir, StackJournal.DONE, individual_image_paths, fingerprint, existing_output)
+                    self.job_finished(stack_dir)
+                    return
+                if entry['state'] == StackJournal.DONE and entry['fingerprint'] == fingerprint:
+                    self.job_finished(stack_dir)
+                    return
+                # otherwise the output is from an interrupted or outdated job and is redone
+            journal.set_state(stack_dir, StackJournal.RUNNING, individual_image_paths, fingerprint, stacked_img_name)
+        elif self.existing_output(stack_dir) is not None:
+            self.job_finished(stack_dir)
+            return
+
+        stack_info = self.read_stack_info(stack_dir)
+        step_warp = None
+        if stack_info is not None:
+            step_warp = self.warp_cache.get(stack_info['step_size'], stack_info['mic_resolution'], stack_info.get('mode'))
+        with self.jobs_changed:
+            self.running[stack_dir] = time.time()
+        pool = self.get_pool()
+        future = pool.submit(run_stacking_job, individual_image_paths, stacked_img_name, step_warp,
+                                  globals.SAVE_DEPTH_MAP, globals.STACKING_DECODE_REDUCTION)
+        future.add_done_callback(lambda f: self.on_job_done(f, pool, stack_dir, stacked_img_name, stack_info, step_warp, journal))
+
+    def on_job_done(self, future, pool, stack_dir, stacked_img_name, stack_info, step_warp, journal):
+        """
+        Runs in a thread of the pool when a job has finished. Exceptions of
+        done callbacks are swallowed by the pool, so the job is always
+        finished here, otherwise it would hold its worker slot for good.
+        """
+        duration = None
+        try:
+            try:
+                result = future.result()
+            except CancelledError:
+                return
+            except Exception as e:
+                logging.error(f'Stacking of {stack_dir} failed: {e}')
+                if isinstance(e, BrokenProcessPool):
+                    # a worker died (e.g. out of memory), the pool is recreated
+                    self.discard_pool(pool)
+                if journal is not None and journal is self.journal:
+                    journal.set_state(stack_dir, StackJournal.FAILED, error=str(e))
+                return
+            duration = result['duration']
+            if journal is not None and journal is self.journal:
+                journal.set_state(stack_dir, StackJournal.DONE)
+            if stack_info is not None and result['measured_step_warp'] is not None:
+                # the first stack with this step size calibrates the cache, a
+                # cached warp that failed the check is replaced
+                self.warp_cache.store(stack_info['step_size'], stack_info['mic_resolution'], result['measured_step_warp'],
+                                      stack_info.get('mode'))
+        except Exception as e:
+            logging.exception(f'Could not record the result of stacking {stack_dir}: {e}')
+        finally:
+            self.job_finished(stack_dir, duration)
+        if duration is not None:
+            logging.info(f'Wrote stacked Image {stacked_img_name} in {duration:.1f}s ({self.stats()})')
+
+    def job_finished(self, stack_dir, duration=None):
+        with self.jobs_changed:
+            self.running.pop(stack_dir, None)
+            queued_at = self.queued_at.pop(stack_dir, None) if stack_dir not in self.jobs else None
+            if duration is not None:
+                now = time.time()
+                latency = now - queued_at if queued_at is not None else duration
+                self.finished_jobs.append((now, latency, duration))
+            self.jobs_changed.notify()
+
+    def stats(self):
+        """
+        Queue depth, running jobs, jobs per minute and the mean latency (from
+        queuing to the written image) and duration of the jobs finished in
+        the last STACKER_STATS_WINDOW seconds.
+        """
+        with self.jobs_changed:
+            now = time.time()
+            recent = [job for job in self.finished_jobs if now - job[0] <= globals.STACKER_STATS_WINDOW]
+            window = min(globals.STACKER_STATS_WINDOW, now - recent[0][0]) if recent else 0
+            return {
+                'queue_depth': len(self.jobs),
+                'running': len(self.running),
+                'workers': self.workers,
+                'allowed_workers': self.governor.allowed_workers,
+                'jobs_per_min': round(len(recent) / (window / 60), 2) if window > 0 else float(len(recent)),
+                'mean_latency_s': round(sum(job[1] for job in recent) / len(recent), 2) if recent else None,
+                'mean_duration_s': round(sum(job[2] for job in recent) / len(recent), 2) if recent else None,
+            }
+
+    def watch(self, working_dir):
+        """Watches the working dir for images added from outside"""
+        self.stop_watching()
+        if not os.path.isdir(working_dir):
+            logging.error(f'Cannot watch {working_dir} for new stacks: not a directory')
+            return
+        self.observer = Observer()
+        self.observer.schedule(StackDirHandler(self), working_dir, recursive=True)
+        self.observer.start()
+
+    def stop_watching(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer = None
+
+    def read_stack_info(self, stack_dir):
+        info_path = os.path.join(stack_dir, globals.STACK_INFO_FILE_NAME)
+        if not os.path.isfile(info_path):
+            return None
+        try:
+            with open(info_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f'Could not read stack info {info_path}: {e}')
+            return None
+
     def interrupt(self):
-        self.interrupted = True
+        with self.jobs_changed:
+            self.interrupted = True
+            self.jobs_changed.notify()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
 
     def set_working_dir(self,working_dir):
-        self.working_dir = working_dir
\ No newline at end of file
+        with self.jobs_changed:
+            self.working_dir = working_dir
+            self.working_dir_changed = True
+            self.jobs_changed.notify()
+
+
+class StackDirHandler(FileSystemEventHandler):
+    """Queues the stack dir of every image written into RAW_Data/<stack>/"""
+
+    def __init__(self, stacker: Stacker) -> None:
+        super().__init__()
+        self.stacker = stacker
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in ('created', 'moved', 'closed'):
+            return
+        path = event.dest_path if event.event_type == 'moved' else event.src_path
+        stack_dir = os.path.dirname(path)
+        if path.endswith('.png') and os.path.basename(os.path.dirname(stack_dir)) == globals.RAW_DATA_DIR_NAME:
+            self.stacker.add_job(stack_dir, globals.STACKER_SETTLE_TIME)
\ No newline at end of file
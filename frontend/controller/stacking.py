@@ -2,8 +2,12 @@ import cv2
 import numpy
 import typing
 import Entomoscope.globals as globals
+from Entomoscope.utils.write_image_atomic import write_image_atomic
 import os
 import PIL.Image
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import gc
 
@@ -20,12 +24,30 @@ class Stacking:
     __HIGHEST_PIXEL_VALUE = globals.HIGHEST_PIXEL_VALUE
     __NUMBER_MATCHES = globals.NUMBER_MATCHES
     __OFFSET = globals.OFFSET
+    __TILE_SIZE = globals.STACKING_TILE_SIZE
+    __FUSION_MODE = globals.FUSION_MODE
+    __PYRAMID_FUSION_LEVELS = globals.PYRAMID_FUSION_LEVELS
+    __ALIGNMENT_MODE = globals.ALIGNMENT_MODE
+    __ALIGNMENT_STRATEGY = globals.ALIGNMENT_STRATEGY
+    __ALIGNMENT_WORKERS = globals.ALIGNMENT_WORKERS
+    __PYRAMID_LEVELS = globals.PYRAMID_ECC_LEVELS
+    __PYRAMID_ITERATIONS = globals.PYRAMID_ECC_ITERATIONS
+    __PYRAMID_FINE_ITERATIONS = globals.PYRAMID_ECC_FINE_ITERATIONS
+    __PYRAMID_CHECK_INTERVAL = globals.PYRAMID_ECC_CHECK_INTERVAL
+    __PYRAMID_EPS = globals.PYRAMID_ECC_EPS
+    __WARP_CACHE_MAX_CORRECTION = globals.WARP_CACHE_MAX_CORRECTION
+    __WARP_CACHE_CHECK_ITERATIONS = globals.WARP_CACHE_CHECK_ITERATIONS
     
     def __init__(self) -> None:
         image_width = globals.IMAGE_WIDTH
         image_height = globals.IMAGE_HEIGHT
         self.__image_width = image_width
         self.__image_height = image_height
+        # per level report of every aligned pair of the last do_stacking by image index
+        self.alignment_reports = {}
+        self.step_warps = []
+        self.index_map = None
+        self.depth_map = None
 
     
     def findHomography(self, 
@@ -58,6 +80,40 @@ class Stacking:
         return homography
     
 
+    def find_warp_ecc(self,
+                    template: numpy.ndarray,
+                    image: numpy.ndarray,
+                    warp_matrix: numpy.ndarray = None,
+        ) -> numpy.ndarray:
+        """
+        Estimates the translation between two gray images with ECC at full
+        resolution.
+
+        :param template:
+            gray reference image
+        :param image:
+            gray image to align
+        :param warp_matrix:
+            optional initial guess for the warp
+        :return: warp matrix
+        """
+        warp_mode = cv2.MOTION_TRANSLATION
+        if warp_matrix is None:
+            warp_matrix = numpy.eye(2, 3, dtype=numpy.float32)
+        else:
+            warp_matrix = warp_matrix.astype(numpy.float32)
+
+        number_of_iterations = 5000
+        termination_eps = 1e-10
+        criteria = (cv2.TERM_CRITERIA_EPS / cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
+        criteria = list(criteria)
+        criteria[0] = int(criteria[0])
+        criteria = tuple(criteria)
+        
+        _, warp_matrix = cv2.findTransformECC(template, image, warp_matrix, warp_mode, criteria)
+        return warp_matrix
+
+
     def align_images(self, 
                     image1, 
                     image2
@@ -69,22 +125,192 @@ class Stacking:
         im2_gray = cv2.cvtColor(im2, cv2.COLOR_BGR2GRAY)
 
         sz = im1.shape
-        warp_mode = cv2.MOTION_TRANSLATION
-        warp_matrix = numpy.eye(2, 3, dtype=numpy.float32)
-
-        number_of_iterations = 5000
-        termination_eps = 1e-10
-        criteria = (cv2.TERM_CRITERIA_EPS / cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
-        criteria = list(criteria)
-        criteria[0] = int(criteria[0])
-        criteria = tuple(criteria)
-        
-        _, warp_matrix = cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, warp_mode, criteria)
+        warp_matrix = self.find_warp_ecc(im1_gray, im2_gray)
         im2_aligned = cv2.warpAffine(im2, warp_matrix, (sz[1], sz[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
 
         return im2_aligned
+
+
+    def find_warp_pyramid(self,
+                    template: numpy.ndarray,
+                    image: numpy.ndarray,
+                    warp_matrix: numpy.ndarray = None,
+        ) -> typing.Tuple[numpy.ndarray, typing.List[dict]]:
+        """
+        Estimates the translation between two gray images with ECC on a
+        Gaussian pyramid. Every level starts from the warp of the coarser
+        level and stops as soon as the warp changes less than PYRAMID_ECC_EPS
+        full resolution pixels. If the half resolution level already
+        converged, the full resolution is skipped.
+
+        :param template:
+            gray reference image
+        :param image:
+            gray image to align
+        :param warp_matrix:
+            optional initial guess for the warp at full resolution
+        :return: warp at full resolution and one report dict per level
+            (level, width, height, iterations, time)
+        """
+        levels = Stacking.__PYRAMID_LEVELS
+        templates = [template]
+        images = [image]
+        for _ in range(levels):
+            templates.append(cv2.pyrDown(templates[-1]))
+            images.append(cv2.pyrDown(images[-1]))
+
+        if warp_matrix is None:
+            warp_matrix = numpy.eye(2, 3, dtype=numpy.float32)
+        else:
+            warp_matrix = warp_matrix.astype(numpy.float32)
+        warp_matrix[:, 2] /= 2 ** levels
+
+        report = []
+        converged = False
+        for level in range(levels, -1, -1):
+            if level < levels:
+                warp_matrix[:, 2] *= 2
+            if level == 0 and converged:
+                report.append({'level': 0, 'width': image.shape[1], 'height': image.shape[0], 'iterations': 0, 'time': 0.0})
+                break
+
+            if level == 0:
+                max_iterations = Stacking.__PYRAMID_FINE_ITERATIONS
+            else:
+                max_iterations = Stacking.__PYRAMID_ITERATIONS
+            step = Stacking.__PYRAMID_CHECK_INTERVAL
+            criteria = (cv2.TERM_CRITERIA_COUNT, step, 0)
+
+            start = time.perf_counter()
+            iterations = 0
+            converged = False
+            while iterations < max_iterations:
+                previous = warp_matrix.copy()
+                try:
+                    _, warp_matrix = cv2.findTransformECC(templates[level], images[level], warp_matrix, cv2.MOTION_TRANSLATION, criteria)
+                except cv2.error as e:
+                    logging.warning(f'ECC did not converge on pyramid level {level}: {e}')
+                    warp_matrix = previous
+                    break
+                iterations += step
+                update = numpy.abs(warp_matrix[:, 2] - previous[:, 2]).max() * 2 ** level
+                if update < Stacking.__PYRAMID_EPS:
+                    converged = True
+                    break
+
+            report.append({
+                'level': level,
+                'width': images[level].shape[1],
+                'height': images[level].shape[0],
+                'iterations': iterations,
+                'time': time.perf_counter() - start,
+            })
+
+        levels = ', '.join(f'L{r["level"]}: {r["iterations"]} it {r["time"]:.3f}s' for r in report)
+        logging.info(f'Pyramid alignment ({levels})')
+        return warp_matrix, report
     
 
+    def check_warp(self,
+                    template: numpy.ndarray,
+                    image: numpy.ndarray,
+                    warp_matrix: numpy.ndarray,
+        ) -> bool:
+        """
+        Quick check of a warp that was not estimated for this pair (e.g. from
+        the WarpCache). A short ECC refinement starts from the warp on the
+        central half of the template at half resolution; the warp is kept if
+        the refinement moves it by at most WARP_CACHE_MAX_CORRECTION full
+        resolution pixels.
+
+        :param template:
+            gray reference image
+        :param image:
+            gray image to align
+        :param warp_matrix:
+            warp to check
+        :return: True if the warp needs no correction
+        """
+        scale = 2
+        height, width = template.shape[0] // scale, template.shape[1] // scale
+        small_template = cv2.resize(template, (width, height), interpolation=cv2.INTER_AREA)
+        small_image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        # the crop of the template starts at (x0, y0) of the uncropped image
+        x0, y0 = width // 4, height // 4
+        crop = small_template[y0:y0 + height // 2, x0:x0 + width // 2]
+        guess = warp_matrix.astype(numpy.float32).copy()
+        guess[:, 2] /= scale
+        guess[:, 2] += guess[:, :2] @ numpy.array([x0, y0], dtype=numpy.float32)
+
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, Stacking.__WARP_CACHE_CHECK_ITERATIONS, 1e-3)
+        try:
+            _, refined = cv2.findTransformECC(crop, small_image, guess.copy(), cv2.MOTION_TRANSLATION, criteria)
+        except cv2.error as e:
+            logging.debug(f'Refinement of the cached warp failed: {e}')
+            return False
+        correction = float(numpy.abs(refined[:, 2] - guess[:, 2]).max()) * scale
+        logging.debug(f'Correction of the cached warp: {correction:.2f}px')
+        return correction <= Stacking.__WARP_CACHE_MAX_CORRECTION
+
+
+    def find_warp(self,
+                    template: numpy.ndarray,
+                    image: numpy.ndarray,
+                    alignment_mode: str,
+                    warp_guess: numpy.ndarray = None,
+        ) -> typing.Tuple[numpy.ndarray, bool, list]:
+        """
+        Estimates the warp between two gray images. A given guess is used
+        directly if it passes check_warp, otherwise it is the starting point
+        of the estimation. Nothing is stored on self, so pairs can be
+        estimated in parallel.
+
+        :param template:
+            gray reference image
+        :param image:
+            gray image to align
+        :param alignment_mode:
+            'pyramid' or 'ecc'
+        :param warp_guess:
+            optional guess for the warp, e.g. from the WarpCache
+        :return: warp matrix, whether the guess was used unchanged and the
+            per level report of the pyramid alignment (empty otherwise)
+        """
+        if warp_guess is not None and self.check_warp(template, image, warp_guess):
+            return warp_guess.astype(numpy.float32), True, []
+        report = []
+        if alignment_mode == 'pyramid':
+            warp_matrix, report = self.find_warp_pyramid(template, image, warp_guess)
+        elif alignment_mode == 'ecc':
+            warp_matrix = self.find_warp_ecc(template, image, warp_guess)
+        else:
+            raise ValueError(f'Unknown alignment mode: {alignment_mode}')
+        return warp_matrix, False, report
+
+
+    def scale_translation(self,
+                    warp_matrix: numpy.ndarray,
+                    factor: float,
+        ) -> numpy.ndarray:
+        """
+        Translation warp with the translation of warp_matrix times factor,
+        e.g. the warp over several stack steps from the warp of one step.
+        """
+        scaled = numpy.eye(2, 3, dtype=numpy.float32)
+        scaled[:, 2] = warp_matrix[:, 2] * factor
+        return scaled
+
+
+    def measured_step_warp(self) -> typing.Optional[numpy.ndarray]:
+        """
+        Median warp of one stack step over all pairs estimated in the last
+        do_stacking, None if every pair used the given step warp.
+        """
+        if not self.step_warps:
+            return None
+        return numpy.median(numpy.asarray(self.step_warps), axis=0).astype(numpy.float32)
+
+
     def focus_stack(self,
                     unimages: typing.List[numpy.ndarray]
         ) -> numpy.ndarray:
@@ -92,36 +318,174 @@ class Stacking:
         Find the sharpest area of each of the superimposed images 
         and generates an image from the different sharp areas.
 
+        The index of the chosen image per pixel is kept in self.index_map.
+
         :param unimages: 
             list of images for the focus stacking
         :return: list of images
         """
         #self.__images = self.align_images(unimages, distance)
 
-        laplacians_img = []
-        for i in range(len(unimages)):
-            image = cv2.cvtColor(unimages[i], cv2.COLOR_BGR2GRAY)
-            blurred = cv2.GaussianBlur(image, (Stacking.__BLUR_SIZE, Stacking.__BLUR_SIZE), Stacking.__SIGMAX)
-            laplacian = cv2.Laplacian(blurred, cv2.CV_64F, ksize=Stacking.__KERNEL_SIZE)
-            laplacians_img.append(laplacian)
-        laplacians_img = numpy.asarray(laplacians_img)
-        output = numpy.zeros(shape=unimages[0].shape, dtype=unimages[0].dtype)
-
-        abs_laplacians_img = numpy.absolute(laplacians_img)
-        maxima = abs_laplacians_img.max(axis=0)
-        bool_mask = abs_laplacians_img == maxima
-        mask = bool_mask.astype(numpy.uint8)
-
-        for i in range(len(unimages)):
-            output = cv2.bitwise_not(unimages[i], output, mask=mask[i])
-        
-        del laplacians_img
-        del abs_laplacians_img
-        del bool_mask
-        del mask
+        sharpness = numpy.asarray([self._sharpness_map(image) for image in unimages])
+        # a single winner per pixel: the last image with the highest score,
+        # as in focus_stack_streaming
+        reversed_index = numpy.argmax(sharpness[::-1], axis=0)
+        del sharpness
+        self.index_map = (len(unimages) - 1 - reversed_index).astype(numpy.uint8)
+
+        output = numpy.take_along_axis(numpy.asarray(unimages), self.index_map[None, :, :, None].astype(numpy.intp), axis=0)[0]
         gc.collect()
-        
-        return Stacking.__HIGHEST_PIXEL_VALUE - output
+
+        return output
+
+
+    def focus_stack_streaming(self,
+                    unimages: typing.Iterable[numpy.ndarray],
+                    tile_size: int = None,
+        ) -> numpy.ndarray:
+        """
+        Same selection as focus_stack, but the images are consumed one at a
+        time and the Laplacian is evaluated tile by tile. Only the output,
+        the best score and the index of the best image are kept for the
+        whole frame, so the memory does not grow with the number of images.
+        As in focus_stack, the last image with the highest score wins and
+        its index per pixel is kept in self.index_map.
+
+        :param unimages:
+            iterable of images for the focus stacking
+        :param tile_size:
+            edge length of the tiles in pixels
+        :return: stacked image
+        """
+        if tile_size is None:
+            tile_size = Stacking.__TILE_SIZE
+        # blurred pixels are only exact this far away from the tile edge
+        border = Stacking.__BLUR_SIZE // 2 + Stacking.__KERNEL_SIZE // 2
+
+        output = None
+        for index, image in enumerate(unimages):
+            height, width = image.shape[:2]
+            if output is None:
+                output = numpy.empty_like(image)
+                best_score = numpy.full((height, width), -1, dtype=numpy.float32)
+                best_index = numpy.zeros((height, width), dtype=numpy.uint8)
+
+            for y0 in range(0, height, tile_size):
+                y1 = min(y0 + tile_size, height)
+                py0 = max(y0 - border, 0)
+                py1 = min(y1 + border, height)
+                for x0 in range(0, width, tile_size):
+                    x1 = min(x0 + tile_size, width)
+                    px0 = max(x0 - border, 0)
+                    px1 = min(x1 + border, width)
+
+                    score = self._sharpness_map(image[py0:py1, px0:px1])
+                    score = score[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+                    best = best_score[y0:y1, x0:x1]
+                    mask = score >= best
+                    numpy.copyto(best, score, where=mask)
+                    best_index[y0:y1, x0:x1][mask] = index
+                    numpy.copyto(output[y0:y1, x0:x1], image[y0:y1, x0:x1], where=mask[..., None])
+
+        if output is None:
+            raise ValueError('No images given for focus stacking')
+        self.index_map = best_index
+        return output
+
+
+    def focus_stack_pyramid(self,
+                    unimages: typing.Iterable[numpy.ndarray],
+                    levels: int = None,
+        ) -> numpy.ndarray:
+        """
+        Multi-scale fusion. Every image is decomposed into a Laplacian
+        pyramid; on each level the coefficients with the highest activity
+        (absolute value summed over the channels) are kept and the coarsest
+        level is averaged. Selecting per frequency band instead of per pixel
+        avoids the halos and noise of the hard selection at bristles and
+        wing edges. The images are consumed one at a time and the
+        coefficients are kept as int16, which holds the differences of uint8
+        images exactly. The selection on the finest level is kept in
+        self.index_map.
+
+        :param unimages:
+            iterable of images for the focus stacking
+        :param levels:
+            number of Laplacian levels, see globals.PYRAMID_FUSION_LEVELS
+        :return: stacked image
+        """
+        if levels is None:
+            levels = Stacking.__PYRAMID_FUSION_LEVELS
+
+        fused = None
+        count = 0
+        for index, image in enumerate(unimages):
+            pyramid = self._laplacian_pyramid(image, levels)
+            count += 1
+            if fused is None:
+                fused = pyramid[:-1]
+                activity = [self._activity(laplacian) for laplacian in fused]
+                base_sum = pyramid[-1].astype(numpy.float32)
+                best_index = numpy.zeros(image.shape[:2], dtype=numpy.uint8)
+                continue
+
+            for level, laplacian in enumerate(pyramid[:-1]):
+                level_activity = self._activity(laplacian)
+                mask = level_activity >= activity[level]
+                numpy.copyto(activity[level], level_activity, where=mask)
+                numpy.copyto(fused[level], laplacian, where=mask[..., None])
+                if level == 0:
+                    best_index[mask] = index
+            base_sum += pyramid[-1]
+            del pyramid
+
+        if fused is None:
+            raise ValueError('No images given for focus stacking')
+
+        result = numpy.rint(base_sum / count).astype(numpy.int16)
+        for laplacian in reversed(fused):
+            result = cv2.pyrUp(result, dstsize=(laplacian.shape[1], laplacian.shape[0])) + laplacian
+        self.index_map = best_index
+        return numpy.clip(result, 0, Stacking.__HIGHEST_PIXEL_VALUE).astype(numpy.uint8)
+
+
+    def _laplacian_pyramid(self,
+                    image: numpy.ndarray,
+                    levels: int,
+        ) -> typing.List[numpy.ndarray]:
+        """
+        Laplacian pyramid of a uint8 image: levels int16 difference images
+        from fine to coarse, followed by the coarsest Gaussian level.
+        """
+        pyramid = []
+        gaussian = image
+        for _ in range(levels):
+            smaller = cv2.pyrDown(gaussian)
+            expanded = cv2.pyrUp(smaller, dstsize=(gaussian.shape[1], gaussian.shape[0]))
+            pyramid.append(cv2.subtract(gaussian, expanded, dtype=cv2.CV_16S))
+            gaussian = smaller
+        pyramid.append(gaussian)
+        return pyramid
+
+
+    def _activity(self,
+                    laplacian: numpy.ndarray
+        ) -> numpy.ndarray:
+        """Absolute Laplacian coefficients summed over the channels"""
+        return numpy.abs(laplacian).sum(axis=2, dtype=numpy.int16)
+
+
+    def _sharpness_map(self,
+                    image: numpy.ndarray
+        ) -> numpy.ndarray:
+        """
+        Absolute Laplacian of the blurred gray image. The input is uint8, so
+        all values are integers and float32 holds them exactly.
+        """
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(gray, (Stacking.__BLUR_SIZE, Stacking.__BLUR_SIZE), Stacking.__SIGMAX)
+        laplacian = cv2.Laplacian(blurred, cv2.CV_32F, ksize=Stacking.__KERNEL_SIZE)
+        return numpy.absolute(laplacian)
   
     
     def del_edges(self, 
@@ -175,14 +539,152 @@ class Stacking:
         return image_list[index_most_sharp] 
     
 
+    def chain_aligned(self,
+                    image_list: typing.Iterable[numpy.ndarray],
+                    alignment_mode: str = None,
+                    step_warp: numpy.ndarray = None,
+        ) -> typing.Iterator[numpy.ndarray]:
+        """
+        Aligns each image to the previously aligned one and yields the
+        aligned images one at a time. The first image only serves as
+        reference for the second one.
+
+        :param image_list:
+            iterable of images
+        :param alignment_mode:
+            'pyramid' (default, see globals.ALIGNMENT_MODE) or 'ecc'
+        :param step_warp:
+            optional warp of one stack step (see WarpCache)
+        :return: iterator over the aligned images
+        """
+        if alignment_mode is None:
+            alignment_mode = Stacking.__ALIGNMENT_MODE
+
+        images = iter(image_list)
+        aligned_image = next(images)
+        sz = aligned_image.shape
+        # all aligned images share the coordinates of the first image,
+        # so the k-th image is k stack steps away from its template
+        for k, image in enumerate(images, 1):
+            start = time.perf_counter()
+            template = cv2.cvtColor(aligned_image, cv2.COLOR_BGR2GRAY)
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            warp_guess = None if step_warp is None else self.scale_translation(step_warp, k)
+            warp_matrix, cached, self.alignment_reports[k] = self.find_warp(template, gray, alignment_mode, warp_guess)
+            if not cached:
+                self.step_warps.append(self.scale_translation(warp_matrix, 1 / k))
+            aligned_image = cv2.warpAffine(image, warp_matrix, (sz[1], sz[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+            source = 'cached' if cached else alignment_mode
+            logging.info(f'Aligned image ({source}) in {time.perf_counter() - start:.3f}s')
+            yield aligned_image
+
+
+    def reference_aligned(self,
+                    image_list: typing.Iterable[numpy.ndarray],
+                    alignment_mode: str = None,
+                    reference_index: int = None,
+                    workers: int = None,
+                    step_warp: numpy.ndarray = None,
+        ) -> typing.Iterator[numpy.ndarray]:
+        """
+        Aligns every image to one reference image instead of the previous
+        one, so errors do not accumulate and the pairs are independent.
+        The warps are estimated in a thread pool (OpenCV releases the GIL),
+        the aligned images are yielded one at a time in the input order.
+
+        :param image_list:
+            iterable of images
+        :param alignment_mode:
+            'pyramid' (default, see globals.ALIGNMENT_MODE) or 'ecc'
+        :param reference_index:
+            index of the reference image, defaults to the middle one
+        :param workers:
+            number of threads, defaults to globals.ALIGNMENT_WORKERS or the
+            number of cores
+        :param step_warp:
+            optional warp of one stack step (see WarpCache)
+        :return: iterator over the aligned images
+        """
+        if alignment_mode is None:
+            alignment_mode = Stacking.__ALIGNMENT_MODE
+        if alignment_mode not in ('pyramid', 'ecc'):
+            raise ValueError(f'Unknown alignment mode: {alignment_mode}')
+
+        images = list(image_list)
+        if reference_index is None:
+            reference_index = len(images) // 2
+        if workers is None:
+            workers = Stacking.__ALIGNMENT_WORKERS or os.cpu_count() or 1
+
+        start = time.perf_counter()
+        grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for i in range(len(images)):
+                if i != reference_index:
+                    steps = i - reference_index
+                    warp_guess = None if step_warp is None else self.scale_translation(step_warp, steps)
+                    futures[i] = executor.submit(self.find_warp, grays[reference_index], grays[i], alignment_mode, warp_guess)
+            warps = {}
+            for i, future in futures.items():
+                warps[i], cached, self.alignment_reports[i] = future.result()
+                if not cached:
+                    self.step_warps.append(self.scale_translation(warps[i], 1 / (i - reference_index)))
+        del grays
+        logging.info(f'Estimated {len(warps)} warps ({alignment_mode}) against image {reference_index} '
+                     f'with {workers} workers in {time.perf_counter() - start:.3f}s')
+
+        sz = images[reference_index].shape
+        for i, image in enumerate(images):
+            if i == reference_index:
+                yield image
+            else:
+                yield cv2.warpAffine(image, warps[i], (sz[1], sz[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+
+
+    def write_depth_map(self,
+                    stacked_img_name: str,
+        ) -> typing.Optional[str]:
+        """
+        Writes the depth map of the last do_stacking as uint8 PNG next to the
+        stacked image (Stacked_<name>.png -> Depth_<name>.png). Every pixel
+        holds the index of the input image it was taken from.
+
+        :param stacked_img_name:
+            path of the stacked image
+        :return: path of the depth map or None if there is none
+        """
+        if self.depth_map is None:
+            return None
+        directory, name = os.path.split(stacked_img_name)
+        depth_map_name = os.path.join(directory, name.replace('Stacked_', 'Depth_', 1))
+        write_image_atomic(depth_map_name, self.depth_map)
+        return depth_map_name
+
+
     def do_stacking(self, 
-                    image_list: numpy.ndarray, 
+                    image_list: typing.Iterable[numpy.ndarray], 
+                    fusion_mode: str = None,
+                    alignment_mode: str = None,
+                    alignment_strategy: str = None,
+                    step_warp: numpy.ndarray = None,
         ) -> numpy.ndarray:
         """
         Runs the stacking process for the image list.
 
         :param image_list:
-            image list as numpy arrays
+            images as numpy arrays, may be a generator
+        :param fusion_mode:
+            'streaming' (default, see globals.FUSION_MODE), 'pyramid' for the
+            multi-scale fusion or 'classic'
+        :param alignment_mode:
+            'pyramid' (default, see globals.ALIGNMENT_MODE) or 'ecc'
+        :param alignment_strategy:
+            'chain' (default, see globals.ALIGNMENT_STRATEGY) aligns each image
+            to the previous one, 'reference' aligns all to the middle image
+        :param step_warp:
+            optional warp of one stack step (see WarpCache), used if it
+            passes check_warp
         :return:
             stacked image as a numpy array
         """
@@ -201,20 +703,41 @@ class Stacking:
         
         return image
         '''
-        aligned_image_list = []
-        image1 = image_list[0]
-        image2 = image_list[1]
+        if fusion_mode is None:
+            fusion_mode = Stacking.__FUSION_MODE
+        if alignment_strategy is None:
+            alignment_strategy = Stacking.__ALIGNMENT_STRATEGY
+        self.step_warps = []
+        self.alignment_reports = {}
+        self.depth_map = None
 
-        aligned_image = self.align_images(image1, image2)
-        aligned_image_list.append(aligned_image)
+        if alignment_strategy == 'chain':
+            aligned_images = self.chain_aligned(image_list, alignment_mode, step_warp=step_warp)
+        elif alignment_strategy == 'reference':
+            aligned_images = self.reference_aligned(image_list, alignment_mode, step_warp=step_warp)
+        else:
+            raise ValueError(f'Unknown alignment strategy: {alignment_strategy}')
 
-        for image in image_list[2:]:
-            aligned_image = self.align_images(aligned_image_list[-1], image)
-            aligned_image_list.append(aligned_image)
+        start = time.perf_counter()
+        if fusion_mode == 'streaming':
+            stacked_image = self.focus_stack_streaming(aligned_images)
+        elif fusion_mode == 'pyramid':
+            stacked_image = self.focus_stack_pyramid(aligned_images)
+        elif fusion_mode == 'classic':
+            aligned_image_list = list(aligned_images)
+            stacked_image = self.focus_stack(aligned_image_list)
+            del aligned_image_list
+            gc.collect()
+        else:
+            raise ValueError(f'Unknown fusion mode: {fusion_mode}')
+        logging.info(f'Stacked image ({fusion_mode}, {alignment_strategy}) in {time.perf_counter() - start:.3f}s')
 
-        stacked_image = self.focus_stack(aligned_image_list)
-        del aligned_image_list
-        gc.collect()
+        # the chained alignment does not pass on the first image, so the
+        # depth map is shifted to refer to the index of the input image
+        if alignment_strategy == 'chain':
+            self.depth_map = self.index_map + 1
+        else:
+            self.depth_map = self.index_map
 
         #stacked_image = self.del_edges(z_stacked_image)
         #stacked_image.save('/home/pi/Desktop/image_test.png')
@@ -0,0 +1,53 @@
+import time
+from Entomoscope.frontend.controller.stacking import Stacking
+from Entomoscope.frontend.controller.stacked_output import StackedOutputWriter
+import Entomoscope.globals as globals
+from Entomoscope.utils.prefetch_images import prefetch_images
+
+# one Stacking and output writer per worker process
+_stacking_algorithm = None
+_output_writer = None
+
+
+def run_stacking_job(image_paths, stacked_img_name, step_warp=None, save_depth_map=False, reduction=1):
+    """
+    Fuses one stack in a worker process of the Stacker and writes the result.
+    Only picklable values go in and out.
+
+    :param image_paths:
+        sorted paths of the images of the stack
+    :param stacked_img_name:
+        path of the stacked image
+    :param step_warp:
+        cached warp of one stack step or None
+    :param save_depth_map:
+        write Depth_<name>.png next to the stacked image
+    :param reduction:
+        decode and stack at 1/reduction of the resolution (1, 2, 4 or 8)
+        for previews
+    :return: dict with the measured step warp (None if step_warp was used
+        for all pairs) and the duration in seconds
+    """
+    global _stacking_algorithm, _output_writer
+    if _stacking_algorithm is None:
+        _stacking_algorithm = Stacking()
+        _output_writer = StackedOutputWriter()
+    start = time.perf_counter()
+    if step_warp is not None and reduction != 1:
+        step_warp = _stacking_algorithm.scale_translation(step_warp, 1 / reduction)
+    # the next images are decoded while the current ones are aligned and fused
+    individual_images = prefetch_images(image_paths, globals.DECODE_WORKERS, globals.DECODE_MEMORY_BUDGET, reduction)
+    stacked_image = _stacking_algorithm.do_stacking(individual_images, step_warp=step_warp)
+    # the depth map, the stacked image and its derivatives are encoded in parallel
+    depth_map_futures = []
+    if save_depth_map:
+        depth_map_futures.append(_output_writer.submit(_stacking_algorithm.write_depth_map, stacked_img_name))
+    _output_writer.write_all(stacked_img_name, stacked_image, *depth_map_futures)
+    measured_step_warp = _stacking_algorithm.measured_step_warp()
+    if measured_step_warp is not None and reduction != 1:
+        # the warp cache holds warps in full resolution pixels
+        measured_step_warp = _stacking_algorithm.scale_translation(measured_step_warp, reduction)
+    return {
+        'measured_step_warp': measured_step_warp,
+        'duration': time.perf_counter() - start,
+    }
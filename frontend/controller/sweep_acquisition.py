@@ -0,0 +1,75 @@
+import logging
+import time
+import Entomoscope.globals as globals
+
+
+def select_frames(frames, plane_positions):
+    """
+    Picks for every focal plane the frame taken nearest to it.
+
+    :param frames:
+        list of (position, image) in the order they were taken
+    :param plane_positions:
+        ascending positions of the focal planes
+    :return: list of (plane position, position of the frame, image), one per
+        plane with a frame within half a plane distance
+    """
+    if len(frames) == 0:
+        return []
+    tolerance = (plane_positions[1] - plane_positions[0]) / 2 if len(plane_positions) > 1 else float('inf')
+    selected = []
+    for plane_position in plane_positions:
+        position, image = min(frames, key=lambda frame: abs(frame[0] - plane_position))
+        if abs(position - plane_position) <= tolerance:
+            selected.append((plane_position, position, image))
+        else:
+            logging.error(f'No frame near the focal plane at {plane_position:.0f} (nearest {position:.0f})')
+    return selected
+
+
+class SweepAcquisition:
+    """
+    Takes a stack while the axis moves at a constant speed. The frames of the
+    sweep branch of the live view are collected with their capture time and
+    tagged with the position of the axis at that time, which follows from
+    the start time and the constant step rate of the wave. The frame nearest
+    to every focal plane is kept. The speed is chosen so that
+    SWEEP_FRAMES_PER_PLANE frames are taken per plane at SWEEP_FRAME_RATE.
+    Frames have the resolution of the sweep branch, so this is for stacks
+    where preview quality is enough.
+    """
+    def __init__(self, video_widget, linear_axis):
+        self.video_widget = video_widget
+        self.linear_axis = linear_axis
+
+    def sweep_speed(self, step_size_mic_steps):
+        """Speed in microsteps per second for the given distance of the planes"""
+        return max(1, round(step_size_mic_steps * globals.SWEEP_FRAME_RATE / globals.SWEEP_FRAMES_PER_PLANE))
+
+    def run(self, step_size, num_planes):
+        """
+        Sweeps the axis up over num_planes planes step_size micrometers apart,
+        starting at the current position.
+
+        :return: list of (plane position, position of the frame, image) with
+            positions in microsteps
+        """
+        step_size_mic_steps = self.linear_axis.micrometer_to_mic_steps(step_size)
+        start_position = self.linear_axis.get_position()
+        plane_positions = [start_position + i * step_size_mic_steps for i in range(num_planes)]
+        speed = self.sweep_speed(step_size_mic_steps)
+
+        self.video_widget.start_sweep_capture()
+        try:
+            start_time = self.linear_axis.start_sweep_up((num_planes - 1) * step_size_mic_steps, speed, kind=True)
+            self.linear_axis.finish_sweep()
+            # the frame exposed at the end of the sweep
+            time.sleep(2 / globals.SWEEP_FRAME_RATE)
+        finally:
+            timed_frames = self.video_widget.stop_sweep_capture()
+        frames = [(self.linear_axis.sweep_position(capture_time), image)
+                  for capture_time, image in timed_frames if capture_time >= start_time - 1 / globals.SWEEP_FRAME_RATE]
+        selected = select_frames(frames, plane_positions)
+        logging.info(f'Sweep of {num_planes} planes at {speed} steps/s took {time.monotonic() - start_time:.2f}s, '
+                     f'{len(frames)} frames, {len(selected)} planes found')
+        return selected
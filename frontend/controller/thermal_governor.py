@@ -0,0 +1,112 @@
+from threading import Thread, Event
+import logging
+import subprocess
+from gpiozero import CPUTemperature
+import Entomoscope.globals as globals
+from Entomoscope.backend.devices.temperature_sensor import TemperaureSensor
+
+THROTTLED_SYSFS_PATH = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+# bits of the firmware throttle state that are set while the condition lasts
+ARM_FREQUENCY_CAPPED = 0x2
+THROTTLED = 0x4
+SOFT_TEMPERATURE_LIMIT = 0x8
+
+
+class ThermalGovernor(Thread):
+    """
+    Admission control for background jobs. Polls the CPU temperature, the
+    enclosure temperature of the TemperaureSensor and the throttle state of
+    the firmware and derives how many of max_workers jobs may run at once.
+    Concurrency goes down linearly between the reduce and pause
+    temperatures, so the load drops before the firmware throttles, and only
+    goes up again once the temperatures are THERMAL_HYSTERESIS below the
+    level that lowered it. on_change is called with the new number of
+    workers. Without a temp_sensor (e.g. the one of the FanController) it
+    creates its own in run(), as setting up the 1-Wire bus may take seconds.
+    """
+    def __init__(self, max_workers, on_change=None, temp_sensor=None):
+        super(ThermalGovernor, self).__init__(daemon=True)
+        self.max_workers = max_workers
+        self.on_change = on_change
+        self.allowed_workers = max_workers
+        self.cpu = CPUTemperature()
+        self.temp_sensor = temp_sensor
+        self.cpu_temp = None
+        self.enclosure_temp = None
+        self.throttled = 0
+        self.stopped = Event()
+
+    def run(self):
+        if self.temp_sensor is None:
+            self.temp_sensor = TemperaureSensor()
+        while not self.stopped.is_set():
+            try:
+                self.update()
+            except Exception as e:
+                logging.error(f'Could not read thermal state: {e}')
+            self.stopped.wait(globals.THERMAL_POLL_INTERVAL)
+
+    def update(self):
+        self.cpu_temp = self.cpu.temperature
+        # 0 without sensor, None for an invalid reading
+        self.enclosure_temp = self.temp_sensor.get_temp() or 0.0
+        self.throttled = self.read_throttled()
+        allowed_workers = self.target_workers(self.cpu_temp, self.enclosure_temp, self.throttled)
+        if allowed_workers > self.allowed_workers:
+            # only scale up once the temperatures have clearly recovered
+            allowed_workers = max(self.allowed_workers, self.target_workers(
+                self.cpu_temp + globals.THERMAL_HYSTERESIS,
+                self.enclosure_temp + globals.THERMAL_HYSTERESIS,
+                self.throttled,
+            ))
+        if allowed_workers != self.allowed_workers:
+            logging.info(f'Background jobs limited to {allowed_workers} of {self.max_workers} '
+                         f'(CPU {self.cpu_temp:.1f}°C, enclosure {self.enclosure_temp:.1f}°C, throttled 0x{self.throttled:x})')
+            self.allowed_workers = allowed_workers
+            if self.on_change is not None:
+                self.on_change(allowed_workers)
+
+    def target_workers(self, cpu_temp, enclosure_temp, throttled):
+        if throttled & (THROTTLED | ARM_FREQUENCY_CAPPED):
+            return 0
+        load = max(
+            self._load(cpu_temp, globals.THERMAL_REDUCE_CPU_TEMP, globals.THERMAL_PAUSE_CPU_TEMP),
+            self._load(enclosure_temp, globals.THERMAL_REDUCE_ENCLOSURE_TEMP, globals.THERMAL_PAUSE_ENCLOSURE_TEMP),
+        )
+        if load >= 1:
+            return 0
+        workers = max(1, round(self.max_workers * (1 - load)))
+        if throttled & SOFT_TEMPERATURE_LIMIT:
+            workers = min(workers, 1)
+        return workers
+
+    def _load(self, temp, reduce_temp, pause_temp):
+        """0 below reduce_temp, 1 from pause_temp on and linear in between"""
+        if temp is None or temp <= reduce_temp:
+            return 0.0
+        return min(1.0, (temp - reduce_temp) / (pause_temp - reduce_temp))
+
+    def read_throttled(self):
+        """Current throttle state of the firmware as bit mask, 0 if unknown"""
+        try:
+            with open(THROTTLED_SYSFS_PATH) as f:
+                return int(f.read().strip(), 16)
+        except (OSError, ValueError):
+            pass
+        try:
+            output = subprocess.run(['vcgencmd', 'get_throttled'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, timeout=2).stdout.decode()
+            return int(output.strip().split('=')[-1], 16)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            return 0
+
+    def state(self):
+        return {
+            'allowed_workers': self.allowed_workers,
+            'cpu_temp': self.cpu_temp,
+            'enclosure_temp': self.enclosure_temp,
+            'throttled': self.throttled,
+        }
+
+    def interrupt(self):
+        self.stopped.set()
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import tempfile
+import typing
+from threading import Lock
+
+import cv2
+import numpy
+
+import Entomoscope.globals as globals
+from Entomoscope.frontend.controller.stacking import Stacking
+
+
+class WarpCache:
+    """
+    Persistent cache of the warp between two consecutive images of a stack.
+    The axis moves in deterministic microsteps and stacks are taken at a fixed
+    step size, so this warp only depends on the step size and the microstep
+    resolution. Stacking uses it as guess for every pair of a stack. It is
+    shared by the CaptureStackers and the Stacker, so it is thread safe.
+    """
+
+    def __init__(self, path: str = globals.WARP_CACHE_PATH) -> None:
+        self.path = path
+        self.warps = {}
+        self.lock = Lock()
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.warps = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Could not read warp cache {path}: {e}')
+
+    def _key(self, step_size, mic_resolution, mode=None) -> str:
+        # stacks of other acquisition modes (e.g. sweeps) have other image sizes
+        if mode is not None:
+            return f'{mic_resolution}:{step_size}:{mode}'
+        return f'{mic_resolution}:{step_size}'
+
+    def get(self, step_size, mic_resolution, mode=None) -> typing.Optional[numpy.ndarray]:
+        """Returns the warp of one stack step or None if not calibrated"""
+        warp = self.warps.get(self._key(step_size, mic_resolution, mode))
+        if warp is None:
+            return None
+        return numpy.asarray(warp, dtype=numpy.float32)
+
+    def store(self, step_size, mic_resolution, warp_matrix: numpy.ndarray, mode=None) -> None:
+        """Stores the warp of one stack step and saves the cache"""
+        with self.lock:
+            self.warps[self._key(step_size, mic_resolution, mode)] = numpy.asarray(warp_matrix).tolist()
+            self.save()
+        logging.info(f'Stored warp for step size {step_size} at microstep resolution {mic_resolution}'
+                     f'{"" if mode is None else f" ({mode})"}')
+
+    def save(self) -> None:
+        """
+        Writes the cache to a temporary file of its own and renames it
+        atomically. Called with the lock held.
+        """
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.path)),
+                                             prefix=os.path.basename(self.path), suffix='.tmp', delete=False) as f:
+                tmp_path = f.name
+                json.dump(self.warps, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f'Could not write warp cache {self.path}: {e}')
+            if tmp_path is not None and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def calibrate(self,
+                  images: typing.List[numpy.ndarray],
+                  step_size,
+                  mic_resolution,
+                  stacking: Stacking = None,
+                  mode=None,
+        ) -> numpy.ndarray:
+        """
+        Measures the warp of one stack step as the median over all pairs of
+        consecutive images of a stack and stores it.
+
+        :param images:
+            images of a stack taken with the given step size
+        :param mode:
+            acquisition mode of the stack as in its stack info (e.g. 'sweep')
+        :return: warp of one stack step
+        """
+        if len(images) < 2:
+            raise ValueError('At least two images are needed for the calibration')
+        if stacking is None:
+            stacking = Stacking()
+        grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) for image in images]
+        warps = [stacking.find_warp_pyramid(grays[i], grays[i + 1])[0] for i in range(len(grays) - 1)]
+        warp_matrix = numpy.median(numpy.asarray(warps), axis=0).astype(numpy.float32)
+        self.store(step_size, mic_resolution, warp_matrix, mode)
+        return warp_matrix
+
+    def do_stacking(self,
+                    stacking: Stacking,
+                    images: typing.Iterable[numpy.ndarray],
+                    stack_info: typing.Optional[dict],
+                    **kwargs,
+        ) -> numpy.ndarray:
+        """
+        Runs stacking.do_stacking with the cached warp for the parameters in
+        stack_info. If there is none yet or it failed the check of a pair
+        (e.g. after a mechanical change), the warp measured while stacking
+        is stored in its place, so the first stack of a step size
+        calibrates the cache and a drifted warp is replaced.
+
+        :param stack_info:
+            content of the stack info file of the stack or None
+        :return: stacked image
+        """
+        step_warp = None
+        if stack_info is not None:
+            step_warp = self.get(stack_info['step_size'], stack_info['mic_resolution'], stack_info.get('mode'))
+        stacked_image = stacking.do_stacking(images, step_warp=step_warp, **kwargs)
+        if stack_info is not None:
+            # only pairs the cached warp did not pass for were measured
+            measured_warp = stacking.measured_step_warp()
+            if measured_warp is not None:
+                self.store(stack_info['step_size'], stack_info['mic_resolution'], measured_warp, stack_info.get('mode'))
+        return stacked_image
@@ -0,0 +1,69 @@
+from threading import Condition, Thread
+import logging
+import time
+import cv2
+import numpy as np
+import Entomoscope.globals as globals
+
+
+def peaking_overlay(gray, threshold, color):
+    """
+    RGBA image marking the edges of gray in color, transparent elsewhere. An
+    edge is a pixel whose Sobel gradient magnitude (L1) exceeds threshold.
+    """
+    gx = cv2.Sobel(gray, cv2.CV_16S, 1, 0)
+    gy = cv2.Sobel(gray, cv2.CV_16S, 0, 1)
+    magnitude = cv2.add(cv2.absdiff(gx, 0), cv2.absdiff(gy, 0))
+    mask = cv2.dilate((magnitude > threshold).astype(np.uint8), None)
+    overlay = np.zeros(gray.shape + (4,), dtype=np.uint8)
+    overlay[mask.astype(bool)] = (*color, 255)
+    return overlay
+
+
+class FocusPeaking(Thread):
+    """
+    Computes the focus peaking overlay of the live view in its own thread.
+    submit only keeps the latest frame and returns right away, so the
+    streaming thread never waits. Frames are skipped to stay below
+    PEAKING_MAX_RATE overlays per second and to spend at most
+    PEAKING_CPU_SHARE of one core on them. on_overlay gets every overlay as
+    RGBA image.
+    """
+    def __init__(self, on_overlay):
+        super().__init__(daemon=True)
+        self.on_overlay = on_overlay
+        self.frame_ready = Condition()
+        self.frame = None
+        self.next_time = 0.0
+        self.running = True
+
+    def wants_frame(self):
+        """False while the next frame would be skipped anyway"""
+        return time.monotonic() >= self.next_time
+
+    def submit(self, gray):
+        with self.frame_ready:
+            self.frame = gray
+            self.frame_ready.notify()
+
+    def run(self):
+        while True:
+            with self.frame_ready:
+                self.frame_ready.wait_for(lambda: self.frame is not None or not self.running)
+                if not self.running:
+                    return
+                gray, self.frame = self.frame, None
+            start = time.monotonic()
+            try:
+                overlay = peaking_overlay(gray, globals.PEAKING_THRESHOLD, globals.PEAKING_COLOR)
+            except cv2.error as e:
+                logging.error(f'Could not compute the focus peaking: {e}')
+                continue
+            compute_time = time.monotonic() - start
+            self.next_time = start + max(1 / globals.PEAKING_MAX_RATE, compute_time / globals.PEAKING_CPU_SHARE)
+            self.on_overlay(overlay)
+
+    def interrupt(self):
+        with self.frame_ready:
+            self.running = False
+            self.frame_ready.notify()
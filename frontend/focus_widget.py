@@ -1,9 +1,10 @@
 
 from PyQt5.QtWidgets import  QWidget, QLabel, QApplication
+from threading import Condition
+from collections import deque
 import gi
 import logging
 import Entomoscope.globals as globals
-import cv2
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstVideo', '1.0')
@@ -11,6 +12,8 @@ from gi.repository import Gst, GObject, GstVideo
 from gstreamer import GstContext, GstPipeline, GstApp, Gst, GstVideo
 import numpy as np
 import gstreamer.utils as utils
+from gstreamer.gst_hacks import map_gst_buffer
+from Entomoscope.utils.focus_metric import FocusMetric
 GObject.threads_init()
 Gst.init(None)
 
@@ -28,42 +31,87 @@ def extract_buffer(sample: Gst.Sample) -> np.ndarray:
     return np.squeeze(array)  # remove single dimension if exists
 
 
-def calc_focus(image):
-	# compute the Laplacian of the image and then return the focus
-	# measure, which is simply the variance of the Laplacian
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    return cv2.Laplacian(gray, cv2.CV_64F).var()
+def extract_gray(sample: Gst.Sample) -> np.ndarray:
+    """Copies the GRAY8 frame of sample into a np.ndarray"""
+    video_info = GstVideo.VideoInfo.new_from_caps(sample.get_caps())
+    w, h, stride = video_info.width, video_info.height, video_info.stride[0]
+    with map_gst_buffer(sample.get_buffer(), Gst.MapFlags.READ) as mapped:
+        return np.ndarray((h, w), dtype=np.uint8, buffer=mapped, strides=(stride, 1)).copy()
 
-def on_buffer(sink: GstApp.AppSink, data) -> Gst.FlowReturn:
-    """Callback on 'new-sample' signal"""
 
+def measure_buffer(sample: Gst.Sample, tiles = None):
+    """
+    Focus measure of the GRAY8 frame of sample. The buffer is mapped and
+    measured in place, without copying the frame. With tiles as (rows,
+    columns) the measures of the tiles of the whole frame are returned as
+    well, otherwise None.
+    """
+    buffer = sample.get_buffer()
+    video_info = GstVideo.VideoInfo.new_from_caps(sample.get_caps())
+    w, h, stride = video_info.width, video_info.height, video_info.stride[0]
+    with map_gst_buffer(buffer, Gst.MapFlags.READ) as mapped:
+        gray = np.ndarray((h, w), dtype=np.uint8, buffer=mapped, strides=(stride, 1))
+        sharpness = focus_metric(gray)
+        if tiles is None:
+            return sharpness, None
+        return sharpness, focus_metric.tiles(gray, *tiles)
+
+
+focus_metric = FocusMetric(globals.FOCUS_METRIC, globals.FOCUS_ROI, globals.FOCUS_DECIMATION)
+
+# (capture time, sharpness, tile sharpness) of the latest frames of the focus branch,
+# notified for every new one
+sharpness_updated = Condition()
+sharpness_history = deque(maxlen=64)
+
+
+def on_buffer(sink: GstApp.AppSink, capture_time) -> Gst.FlowReturn:
+    """
+    Callback on 'new-sample' signal. capture_time returns the monotonic
+    time the frame of a sample was captured at.
+    """
     sample = sink.emit("pull-sample")  # Gst.Sample
 
     if isinstance(sample, Gst.Sample):
-        array = extract_buffer(sample)
-        #array = cv2.resize(array,(512,512))
-        globals.SHARPNESS = calc_focus(array)
+        sharpness, tiles = measure_buffer(sample, globals.BRACKETING_TILES if globals.STACK_BRACKETING else None)
+        # runs for every frame, the message is only formatted if it is logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f'Focus measure {sharpness:.1f} in {focus_metric.compute_time * 1000:.1f}ms '
+                          f'(mean {focus_metric.mean_compute_time() * 1000:.1f}ms)')
+        with sharpness_updated:
+            globals.SHARPNESS = sharpness
+            sharpness_history.append((capture_time(sample), sharpness, tiles))
+            sharpness_updated.notify_all()
         return Gst.FlowReturn.OK
 
     return Gst.FlowReturn.ERROR
 
 
-class FocusWidget():   
-    def __init__(self):
-        self.setup_pipeline()
-
-    def setup_pipeline(self):           
-        self.pipeline = Gst.Pipeline()
-        self.pipeline = f'libcamerasrc camera-name="{globals.CAMERA_NAME}"  ! resize ! appsink emit-signals=True'
-        self.pipeline = Gst.parse_launch(self.pipeline)
-        self.pipeline.children[0].connect("new-sample", on_buffer, None)
-            
-    def start_pipeline(self):
-        self.pipeline.set_state(Gst.State.PLAYING)
-        while self.pipeline.get_state(100).state != Gst.State.PLAYING:
-            pass
-
-    def pause_pipeline(self):
-        self.pipeline.set_state(Gst.State.NULL)
-        while self.pipeline.get_state(100).state != Gst.State.NULL:
-            pass
\ No newline at end of file
+def measure_after(timestamp, settle_time = None, timeout = 2.0):
+    """
+    Returns (sharpness, tile sharpness) of the first frame captured at least
+    settle_time seconds after the monotonic timestamp, e.g. the time a move
+    of the axis was completed, waiting for it if needed. Frames exposed
+    before or while moving are never used.
+    """
+    settle_time = globals.FOCUS_SETTLE_TIME if settle_time is None else settle_time
+    earliest = timestamp + settle_time
+
+    def first_after():
+        return next((entry for entry in sharpness_history if entry[0] >= earliest), None)
+
+    with sharpness_updated:
+        if not sharpness_updated.wait_for(lambda: first_after() is not None, timeout):
+            raise TimeoutError('No focus measure from the live view')
+        _, sharpness, tiles = first_after()
+        return sharpness, tiles
+
+
+def sharpness_after(timestamp, settle_time = None, timeout = 2.0):
+    """The focus measure of measure_after"""
+    return measure_after(timestamp, settle_time, timeout)[0]
+
+
+def tiles_after(timestamp, settle_time = None, timeout = 2.0):
+    """The tile focus measures of measure_after"""
+    return measure_after(timestamp, settle_time, timeout)[1]
@@ -1,38 +1,125 @@
-import subprocess
 import logging
+from contextlib import contextmanager
 from os.path import exists, isfile
 from os import remove
 from subprocess import TimeoutExpired
+import cv2
+import Entomoscope.globals as globals
+from Entomoscope.backend.devices.camera import LibcameraStillCamera, Picamera2Camera, FakeCamera
+from Entomoscope.utils.write_image_atomic import write_image_atomic
 
 IMAGE_TAKE_TIMEOUT_IN_SECS = 60
 
-class ImageCamera():   
+
+def create_camera_backend(name, video_widget = None, linear_axis = None):
+    """
+    Camera backend for globals.CAMERA_BACKEND: pipeline (stills from the
+    live view pipeline of video_widget, taken after linear_axis settled),
+    picamera2, libcamera-still, fake or simulation (the camera of the
+    virtual microscope)
+    """
+    if name == 'pipeline':
+        if video_widget is not None:
+            from Entomoscope.frontend.video_widget import PipelineCamera
+            return PipelineCamera(video_widget, linear_axis)
+        logging.error('No live view pipeline for the camera. Falling back to picamera2.')
+        name = 'picamera2'
+    if name == 'picamera2':
+        try:
+            import picamera2
+            return Picamera2Camera()
+        except ImportError:
+            logging.error('picamera2 is not installed. Falling back to libcamera-still.')
+            return LibcameraStillCamera(IMAGE_TAKE_TIMEOUT_IN_SECS)
+    if name == 'libcamera-still':
+        return LibcameraStillCamera(IMAGE_TAKE_TIMEOUT_IN_SECS)
+    if name == 'fake':
+        return FakeCamera()
+    if name == 'simulation':
+        from Entomoscope.simulation.virtual_microscope import SimulatedCamera
+        return SimulatedCamera()
+    raise ValueError(f'Unknown camera backend {name}')
+
+
+class ImageCamera():
+    """
+    Takes the full resolution images. With a persistent backend the camera is
+    kept open for all frames taken inside session() and frames are returned
+    in memory by capture(). An exclusive backend needs the
+    live view to be paused while it is used.
+    """
     def __init__(
         self,
         max_tries = 3,
         exposure_time = 3,
+        backend = None,
+        video_widget = None,
+        linear_axis = None,
     ):
         self.exposure_time = exposure_time
         self.max_tries = max_tries
+        self.backend = backend if backend is not None else create_camera_backend(globals.CAMERA_BACKEND, video_widget, linear_axis)
+        self.session_depth = 0
+
+    @property
+    def exclusive(self):
+        return self.backend.exclusive
+
+    @contextmanager
+    def session(self):
+        """Keeps the camera open for all frames taken inside"""
+        if self.session_depth == 0:
+            self.backend.open()
+        self.session_depth += 1
+        try:
+            yield self
+        finally:
+            self.session_depth -= 1
+            if self.session_depth == 0:
+                self.backend.close()
+
+    def capture(self):
+        """Takes a frame and returns it as BGR image or None"""
+        for tries in range(1, self.max_tries + 1):
+            try:
+                with self.session():
+                    return self.backend.capture()
+            except Exception as e:
+                logging.error(f'Could not take image: {e}. Retrying (attempt {tries}/{self.max_tries})')
+                if self.session_depth > 0:
+                    # reopen the camera of the running session
+                    self.backend.close()
+                    self.backend.open()
+        logging.error(f'Could not take image after {self.max_tries} tries.')
+        return None
+
+    def save_image(self, image_path, image):
+        """Writes a captured frame as PNG"""
+        return write_image_atomic(image_path, image, [cv2.IMWRITE_PNG_COMPRESSION, globals.RAW_IMAGE_PNG_LEVEL])
 
-    
     def take_image(self, image_path):
-        if exists(image_path) and not isfile(image_path): 
+        if exists(image_path) and not isfile(image_path):
             logging.error(f'Tried to save image as directory. Aborting! ({image_path})')
             return False
-        tries = 1 
+        if not self.backend.persistent:
+            return self.take_image_subprocess(image_path)
+        image = self.capture()
+        if image is None:
+            return False
+        if not self.save_image(image_path, image):
+            logging.error(f'Could not write image at path: {image_path}')
+            return False
+        return True
+
+    def take_image_subprocess(self, image_path):
+        tries = 1
         image_sucessfully_taken = False
         while tries <= self.max_tries and not image_sucessfully_taken:
             if exists(image_path):
                 remove(image_path)
             try:
-                result = subprocess.run(
-                    ['libcamera-still','-n','-e','png','-t1', f'-o{image_path}'],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    timeout=IMAGE_TAKE_TIMEOUT_IN_SECS
-                )
-                logging.debug(result.stdout.decode('utf-8'))
+                output = self.backend.capture_to_file(image_path)
+                logging.debug(output)
             except TimeoutExpired as e:
                 output = e.output.decode('utf-8')
                 logging.debug(output)
@@ -46,4 +133,3 @@ class ImageCamera():
             return True
         logging.error(f'Could not take image at path: {image_path} after {self.max_tries} tries.')
         return False
-
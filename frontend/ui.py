@@ -10,6 +10,7 @@ import time
 import numpy as np
 import datetime
 import re
+import json
 from turtle import down
 import shutil
 from Entomoscope.backend.components.axis import Axis
@@ -17,12 +18,18 @@ from Entomoscope.backend.devices.fan import Fan
 from Entomoscope.backend.devices.motor import Motor
 from Entomoscope.backend.devices.switch import Switch
 from Entomoscope.backend.devices.temperature_sensor import TemperaureSensor
-from Entomoscope.frontend.controller.stacker import Stacker
-from Entomoscope.frontend.focus_widget import FocusWidget
+from Entomoscope.frontend.controller.stacker import Stacker, stacked_img_name, stack_name
+from Entomoscope.frontend.controller.capture_stacker import CaptureStacker
+from Entomoscope.frontend.controller.stack_acquisition import StackAcquisition
+from Entomoscope.frontend.controller.sweep_acquisition import SweepAcquisition
+from Entomoscope.frontend.controller.autofocus import Autofocus
+from Entomoscope.frontend.controller.focus_history import FocusHistory
+from Entomoscope.frontend.controller.stack_bracketing import StackBracketing
 
 from Entomoscope.frontend.controller.usb_device_watcher import UsbDrivesWatcher
 from Entomoscope.frontend.image_camera import ImageCamera
 from Entomoscope.frontend.video_widget import VideoWidget
+from Entomoscope.frontend.focus_widget import sharpness_after, tiles_after
 from Entomoscope.utils.get_free_space import get_free_space_in_gb
 from Entomoscope.utils.validate_datetime import is_date_valid
 from Entomoscope.utils.is_int import is_int
@@ -193,11 +200,14 @@ class Ui(QMainWindow):
         self,
         ui_file:str,
         num_of_stacks_default:int = 5,
-        stack_step_size_default:int = 500
+        stack_step_size_default:int = 500,
+        temp_sensor = None
     ):
         super(Ui, self).__init__()
         uic.loadUi(ui_file, self)
 
+        # shared with the FanController, the Stacker creates its own without
+        self.temp_sensor = temp_sensor
         self.num_of_stacks_default = num_of_stacks_default
         self.stack_step_size_default = stack_step_size_default
         self.focus_out = self.findChild(QPushButton,'focus_in')
@@ -249,7 +259,8 @@ class Ui(QMainWindow):
         self.free_space_usb = self.findChild(QLabel,'free_space_usb')
         
         self.center_camera = self.findChild(VideoWidget,'center_camera')
-        self.image_camera = ImageCamera()
+        if globals.FOCUS_PEAKING:
+            self.center_camera.start_focus_peaking()
 
         self.hw_light = Light(configuration.LIGHT_PIN)
         self.motor_stepper = Motor(
@@ -275,6 +286,10 @@ class Ui(QMainWindow):
                         configuration.BOTTOM_GAP,
                         configuration.TOP_GAP,
         )
+        self.image_camera = ImageCamera(video_widget=self.center_camera, linear_axis=self.linear_axis)
+        self.focus_history = FocusHistory()
+        # (lowest position, step size, number of planes) from the last autofocus
+        self.stack_bracket = None
 
         self.clickable_elements = [
             self.focus_in,
@@ -455,9 +470,10 @@ class Ui(QMainWindow):
                     single_images_names = set()
                     
                     for img_path in stacked_images_paths:
-                            stacked_images_names.append(re.sub('Stacked_', '', re.sub('.png', '', re.split('/', img_path)[7])))
+                            # without the suffix of stacks fused at reduced resolution
+                            stacked_images_names.append(stack_name(img_path))
 
-                    if count_specimen_folders > len(stacked_images_paths):
+                    if count_specimen_folders > len(set(stacked_images_names)):
                         for specimen in specimen_folders:
                             if specimen not in stacked_images_names:
                                 single_images_names.add(specimen)
@@ -473,8 +489,8 @@ class Ui(QMainWindow):
                             yield item_stacked.next()
 
                     else: 
-                        for specimen in stacked_images_names:
-                            item_stacked = QtCore.QDirIterator(foldersSelectedDirectory[i], ['Stacked_' + specimen + '.png'], QtCore.QDir.Files, QtCore.QDirIterator.Subdirectories, )
+                        for img_path in stacked_images_paths:
+                            item_stacked = QtCore.QDirIterator(foldersSelectedDirectory[i], [os.path.basename(img_path)], QtCore.QDir.Files, QtCore.QDirIterator.Subdirectories, )
                             while item_stacked.hasNext():
                                 yield item_stacked.next()
 
@@ -492,10 +508,10 @@ class Ui(QMainWindow):
             self.show_message_box('Loading Stacks ...')
             itemName = self.gallery_stacked.selectedItems()[0].text()
             if 'Stacked' in itemName:
-                itemNumber = re.sub('.png','',(re.sub('Stacked_','', itemName))) 
+                itemNumber = stack_name(itemName)
                 SpecimenNumber = re.split('_', itemNumber)[0] + '_' + re.split('_', itemNumber)[1]
                 foldersSelectedDirectory = glob(os.path.join(pathSelectedDirectory, SpecimenNumber, globals.RAW_DATA_DIR_NAME, itemNumber))
-                item = QtCore.QDirIterator(foldersSelectedDirectory[0], QtCore.QDir.Files, QtCore.QDirIterator.Subdirectories, )
+                item = QtCore.QDirIterator(foldersSelectedDirectory[0], ['*.png'], QtCore.QDir.Files, QtCore.QDirIterator.Subdirectories, )
                 while item.hasNext(): 
                     filename = item.next()
                     yield filename
@@ -504,7 +520,7 @@ class Ui(QMainWindow):
                 SpecimenNumber = itemNumber[0] + '_' + itemNumber[1]
                 SpecimenFolder = SpecimenNumber + '_' + itemNumber[2]
                 foldersSelectedDirectory = glob(os.path.join(pathSelectedDirectory, SpecimenNumber, globals.RAW_DATA_DIR_NAME, SpecimenFolder))
-                item = QtCore.QDirIterator(foldersSelectedDirectory[0], QtCore.QDir.Files,
+                item = QtCore.QDirIterator(foldersSelectedDirectory[0], ['*.png'], QtCore.QDir.Files,
                                         QtCore.QDirIterator.Subdirectories, )
                 while item.hasNext():
                     filename = item.next()
@@ -533,40 +549,24 @@ class Ui(QMainWindow):
             print(e)
 
     def do_autofocus(self):
-        step_size = globals.STEP_SIZE
-        sharpness_threshold = 3
-        max_tries = 10
-        sharpnesses = []
-        self.center_camera.pause_pipeline()
-        time.sleep(2.0)
-        focus_widget = FocusWidget()
-        focus_widget.start_pipeline()
+        globals.SHARPNESS = -1
+        self.center_camera.start_focus_analysis()
         try:
-            self.linear_axis.move_to(0)
-            while globals.SHARPNESS == -1:
-                pass
-            while self.linear_axis.highest_position() >= self.linear_axis.get_position():
-                self.linear_axis.move_up_for(step_size)
-                sharpnesses.append(globals.SHARPNESS)
-                print(globals.SHARPNESS)
-                if len(sharpnesses) > 5 and abs(sharpnesses[0] - sharpnesses[-1]) > sharpness_threshold and (sharpnesses[-1] < sharpnesses[-2]) and (sharpnesses[-1] < sharpnesses[-3]):
-                    break
+            predicted = self.focus_history.predict(globals.FOCUS_PROFILE, configuration.MIC_RESOLUTION)
+            margin = max(self.linear_axis.micrometer_to_mic_steps(globals.AUTOFOCUS_WARM_MARGIN),
+                         self.focus_history.spread(globals.FOCUS_PROFILE, configuration.MIC_RESOLUTION))
+            autofocus = Autofocus(self.linear_axis, sharpness_after,
+                                  measure_tiles=tiles_after if globals.STACK_BRACKETING else None)
+            position = autofocus.run(predicted, margin)
+            # a position without a clear peak would mislead later predictions
+            if autofocus.peak_confirmed:
+                self.focus_history.add(globals.FOCUS_PROFILE, configuration.MIC_RESOLUTION, position)
+            if globals.STACK_BRACKETING:
+                self.stack_bracket = StackBracketing(self.linear_axis).planes(autofocus.measurements, autofocus.tile_measurements)
         except Exception as e:
             logging.error(e)
-        focus_widget.pause_pipeline()
-        time.sleep(2.0)
-        try:
-            self.center_camera.start_pipeline()
-        except:
-            self.center_camera.start_pipeline()
-        num_steps = abs((len(sharpnesses)) - np.argmax(np.array(sharpnesses)) + 1)
-        tries=0
-        while tries < max_tries:
-            try:
-                self.linear_axis.move_down_for(num_steps*step_size)
-                break
-            except ValueError:
-                num_steps-=1
+        finally:
+            self.center_camera.stop_focus_analysis()
         globals.SHARPNESS = -1
 
     def autofocus_clicked(self):
@@ -630,13 +630,25 @@ class Ui(QMainWindow):
         Path(os.path.join(img_path,img_number)).mkdir(parents=True, exist_ok=True)
         return os.path.join(img_path,img_number), img_number
 
+    def pause_preview(self):
+        """Stops the live view if the image camera can not share the camera with it"""
+        if self.image_camera.exclusive:
+            self.center_camera.pause_pipeline()
+
+    def resume_preview(self):
+        if self.image_camera.exclusive:
+            try:
+                self.center_camera.start_pipeline()
+            except:
+                self.center_camera.start_pipeline()
+
     def take_image_clicked(self):
         logging.info('Take image Clicked')
         self.show_message_box('Taking Image ...')
         save_dir, img_number = self.create_new_dir_for_images()
-        self.center_camera.pause_pipeline()
+        self.pause_preview()
         success = self.image_camera.take_image(os.path.join(save_dir,f'{img_number}_000.png'))
-        self.center_camera.start_pipeline()
+        self.resume_preview()
         self.update_free_space_labels()
         self.hide_message_box()
 
@@ -644,22 +656,69 @@ class Ui(QMainWindow):
         logging.info('Take stack Clicked')
         self.show_message_box('Taking Stack ...')
         stack_step_size = int(self.stack_step_size.text())
+        num_of_stacks = int(self.num_of_stacks.text())
+        if globals.STACK_BRACKETING and self.stack_bracket is not None:
+            # the planes found by the last autofocus, the labels only show them
+            start_position, stack_step_size, num_of_stacks = self.stack_bracket
+            self.set_stack_step_size_label(stack_step_size)
+            self.set_num_of_stacks_label(num_of_stacks)
         position_before_stacks = self.linear_axis.get_position()
-        # move down slightly
         try:
-            self.linear_axis.move_down_for(stack_step_size)
+            if globals.STACK_BRACKETING and self.stack_bracket is not None:
+                self.linear_axis.move_to(start_position, True)
+            else:
+                # move down slightly
+                self.linear_axis.move_down_for(stack_step_size)
         except Exception as e:
             print(e)
         save_dir, img_number = self.create_new_dir_for_images()
-        self.center_camera.pause_pipeline()
-        for i in range(int(self.num_of_stacks.text())):
-            success = self.image_camera.take_image(os.path.join(save_dir,f'{img_number}_{i:03d}.png')) 
-            self.linear_axis.move_up_for(stack_step_size)
-        self.center_camera.start_pipeline()
+        stack_info = {
+            'step_size': stack_step_size,
+            'mic_resolution': configuration.MIC_RESOLUTION,
+            'num_of_stacks': num_of_stacks,
+        }
+        # a sweep takes the frames from the running live view
+        sweep = globals.STACK_ACQUISITION_MODE == 'sweep' and not self.image_camera.exclusive
+        if sweep:
+            stack_info['mode'] = 'sweep'
+        with open(os.path.join(save_dir, globals.STACK_INFO_FILE_NAME), 'w') as f:
+            json.dump(stack_info, f)
+        capture_stacker = None
+        if globals.INCREMENTAL_STACKING and self.stacker is not None and self.fuse_stacks.isChecked():
+            # fused from the full resolution frames
+            capture_stacker = CaptureStacker(save_dir, stacked_img_name(save_dir), stack_info, self.stacker)
+            capture_stacker.start()
+        self.pause_preview()
+        image_paths = [os.path.join(save_dir,f'{img_number}_{i:03d}.png') for i in range(num_of_stacks)]
+        try:
+            if sweep:
+                self.take_sweep_stack(image_paths, stack_step_size, capture_stacker)
+            else:
+                # frames are written while the axis moves to the next position
+                acquisition = StackAcquisition(self.image_camera, self.linear_axis, stack_step_size,
+                                               on_frame=capture_stacker.add_frame if capture_stacker is not None else None)
+                acquisition.run(image_paths)
+        except Exception as e:
+            logging.error(f'Could not take stack: {e}')
+        if capture_stacker is not None:
+            capture_stacker.finish()
+        elif self.stacker is not None:
+            self.stacker.add_job(save_dir)
+        self.resume_preview()
         self.linear_axis.move_to(position_before_stacks,True)
         self.update_free_space_labels()
         self.hide_message_box()
 
+    def take_sweep_stack(self, image_paths, stack_step_size, capture_stacker=None):
+        """Takes the frames of a stack while the axis moves continuously (see SweepAcquisition)"""
+        selected = SweepAcquisition(self.center_camera, self.linear_axis).run(stack_step_size, len(image_paths))
+        for image_path, (_, _, image) in zip(image_paths, selected):
+            if not self.image_camera.save_image(image_path, image):
+                logging.error(f'Could not write image at path: {image_path}')
+                continue
+            if capture_stacker is not None:
+                capture_stacker.add_frame(image)
+
     def new_directory_clicked(self):
         logging.info('New Directory Clicked')
         directory = time.strftime(globals.DIRECTORY_NAMING_FORMAT)
@@ -726,14 +785,10 @@ class Ui(QMainWindow):
         logging.info('Classify image Clicked')
         self.show_message_box('Taking Image ...')
         save_dir, img_number = self.create_new_dir_for_images()
-        self.center_camera.pause_pipeline()
+        self.pause_preview()
         self.image_camera.take_image(os.path.join(save_dir,f'{img_number}_000.png'))
-        time.sleep(2.5)
         self.hide_message_box()
-        try:
-            self.center_camera.start_pipeline()
-        except:
-            self.center_camera.start_pipeline()
+        self.resume_preview()
         self.update_free_space_labels()
         self.show_message_box('Loading image to image processor ...')
         specimen_to_classify = cv2.imread('{0}/{1}_000.png'.format(save_dir, img_number))
@@ -863,6 +918,9 @@ class Ui(QMainWindow):
         self.current_specimen_text.clear()
         self.current_specimen_text.insertPlainText(self.current_specimen.split(globals.SPECIMENS_PREFIX)[1])
         logging.info(f'New Specimen : {self.current_specimen}')
+        self.stack_bracket = None
+        if self.stacker is not None:
+            self.stacker.set_priority_folder(os.path.join(self.current_target_dir, self.current_specimen))
 
     def selected_device_changed(self,selected,deselcted):
         if len(self.current_device_selection.selectedItems()) > 1:
@@ -945,6 +1003,9 @@ class Ui(QMainWindow):
             for file_name in os.listdir(os.path.join(globals.LOCAL_DIR, globals.WORKING_DIR)):
                 source = os.path.join(globals.LOCAL_DIR, globals.WORKING_DIR, file_name)
                 destination = os.path.join(globals.USB_DIR, globals.WORKING_DIR, file_name)
+                if not os.path.isdir(source):
+                    # e.g. the stacking journal
+                    continue
                 shutil.copytree(source, destination, symlinks=True, dirs_exist_ok=True)
             self.hide_message_box()
 
@@ -1027,7 +1088,7 @@ class Ui(QMainWindow):
             itemName = self.gallery_stacked.selectedItems()[0].text()
             global itemPath
             if 'Stacked' in itemName:
-                itemNumber = re.sub('.png','',(re.sub('Stacked_','', itemName)))
+                itemNumber = stack_name(itemName)
                 SpecimenNumber = re.split('_', itemNumber)[0] + '_' + re.split('_', itemNumber)[1]
                 itemPath = glob(os.path.join(pathSelectedDirectory, SpecimenNumber + '/' + itemName))
             else:
@@ -1101,7 +1162,9 @@ class Ui(QMainWindow):
         logging.info('Fuse Stacks Clicked')
         if self.fuse_stacks.isChecked():
             logging.info('Fuse Stacks Checked')
-            self.stacker = Stacker(self.working_dir)
+            self.stacker = Stacker(self.working_dir, temp_sensor=self.temp_sensor)
+            if self.current_target_dir is not None and self.current_specimen is not None:
+                self.stacker.set_priority_folder(os.path.join(self.current_target_dir, self.current_specimen))
             self.stacker.start()
         else:
             logging.info('Fuse Stacks Unchecked')
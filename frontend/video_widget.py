@@ -1,31 +1,111 @@
-
 from PyQt5.QtWidgets import  QWidget, QLabel, QApplication
+from threading import Lock, Thread
+import time
 import gi
 import logging
 import Entomoscope.globals as globals
+from Entomoscope.frontend.focus_widget import extract_buffer, extract_gray, on_buffer
+from Entomoscope.frontend.focus_peaking import FocusPeaking
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstVideo', '1.0')
-from gi.repository import Gst, GObject, GstVideo
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gst, GObject, GstVideo, GdkPixbuf, GLib
 GObject.threads_init()
 Gst.init(None)
 
-class VideoWidget(QWidget):   
+class VideoWidget(QWidget):
+    """
+    Live view of the camera. A single pipeline runs all the time. The camera
+    delivers two streams: a PREVIEW_WIDTH x PREVIEW_HEIGHT one scaled by the
+    ISP, whose tee feeds the preview, a low resolution appsink for the focus
+    measure, an appsink collecting timestamped frames during sweeps and a
+    low resolution appsink for the focus peaking overlay, and a full
+    resolution one that only feeds the appsink for stills. All but the
+    preview are switched with valves, so nothing needs a state change of the
+    pipeline, and no full resolution frame is converted or scaled in
+    software unless a still is taken. The focus peaking overlay is blended
+    into the preview by a gdkpixbufoverlay, so it needs no widget on top of
+    the video.
+    """
     def __init__(self, parent):
         super(VideoWidget, self).__init__(parent)
         self.windowId = self.winId()
+        self.still_lock = Lock()
+        self.peaking = None
+        self.peaking_lock = Lock()
         self.setup_pipeline()
         self.start_pipeline()
 
-    def setup_pipeline(self):           
+    def setup_pipeline(self):
         self.pipeline = Gst.Pipeline()
-        self.pipeline = f'libcamerasrc camera-name="{globals.CAMERA_NAME}" ! videoscale ! videoflip method=counterclockwise ! glimagesink'
+        preview_source, still_source = self.pipeline_sources()
+        self.pipeline = (
+            f'{preview_source} '
+            f'! video/x-raw,width={globals.PREVIEW_WIDTH},height={globals.PREVIEW_HEIGHT} ! tee name=t '
+            't. ! queue leaky=downstream max-size-buffers=1 ! videoconvert '
+            f'! gdkpixbufoverlay name=peaking_overlay alpha=0 overlay-width={globals.PREVIEW_WIDTH} '
+            f'overlay-height={globals.PREVIEW_HEIGHT} ! videoscale ! videoflip method=counterclockwise ! glimagesink '
+            't. ! queue leaky=downstream max-size-buffers=1 ! valve name=focus_valve drop=true ! videoscale ! videoconvert '
+            f'! video/x-raw,format=GRAY8,width={globals.FOCUS_WIDTH},height={globals.FOCUS_HEIGHT} '
+            '! appsink name=focus_sink emit-signals=true max-buffers=1 drop=true sync=false '
+            't. ! queue leaky=downstream max-size-buffers=2 ! valve name=sweep_valve drop=true ! videoscale ! videoconvert '
+            f'! video/x-raw,format=BGR,width={globals.SWEEP_WIDTH},height={globals.SWEEP_HEIGHT} '
+            '! appsink name=sweep_sink emit-signals=true max-buffers=4 sync=false '
+            't. ! queue leaky=downstream max-size-buffers=1 ! valve name=peaking_valve drop=true ! videoscale ! videoconvert '
+            f'! video/x-raw,format=GRAY8,width={globals.PEAKING_WIDTH},height={globals.PEAKING_HEIGHT} '
+            '! appsink name=peaking_sink emit-signals=true max-buffers=1 drop=true sync=false '
+            f'{still_source} ! video/x-raw,width={globals.PIPELINE_WIDTH},height={globals.PIPELINE_HEIGHT} '
+            '! queue leaky=downstream max-size-buffers=1 ! valve name=still_valve drop=true ! videoconvert '
+            '! video/x-raw,format=BGR ! appsink name=still_sink max-buffers=1 drop=true sync=false'
+        )
         self.pipeline = Gst.parse_launch(self.pipeline)
+        self.focus_valve = self.pipeline.get_by_name('focus_valve')
+        self.still_valve = self.pipeline.get_by_name('still_valve')
+        self.still_sink = self.pipeline.get_by_name('still_sink')
+        self.pipeline.get_by_name('focus_sink').connect('new-sample', on_buffer, self.capture_time)
+        self.sweep_valve = self.pipeline.get_by_name('sweep_valve')
+        self.pipeline.get_by_name('sweep_sink').connect('new-sample', self.on_sweep_sample)
+        self.sweep_frames = None
+        self.peaking_valve = self.pipeline.get_by_name('peaking_valve')
+        self.peaking_overlay = self.pipeline.get_by_name('peaking_overlay')
+        self.pipeline.get_by_name('peaking_sink').connect('new-sample', self.on_peaking_sample)
+        if globals.SIMULATION:
+            Thread(target=self.feed_simulated_frames, args=(self.pipeline.get_by_name('sim_src'),), daemon=True).start()
         bus =  self.pipeline.get_bus()
         bus.add_signal_watch()
         bus.enable_sync_message_emission()
         bus.connect('sync-message::element', self.on_sync_message)
 
+    def pipeline_sources(self):
+        """Descriptions of the source of the preview stream and of the full resolution stream"""
+        if globals.SIMULATION:
+            # frames of the virtual microscope are pushed by feed_simulated_frames,
+            # the preview stream is scaled in software
+            return (
+                'appsrc name=sim_src is-live=true do-timestamp=true format=time '
+                f'caps=video/x-raw,format=BGR,width={globals.PIPELINE_WIDTH},height={globals.PIPELINE_HEIGHT},'
+                f'framerate={globals.SIM_FRAME_RATE}/1 ! videoconvert ! tee name=sim_t '
+                'sim_t. ! queue leaky=downstream max-size-buffers=1 ! videoscale',
+                'sim_t.',
+            )
+        # the view finder stream is scaled by the ISP, the still capture
+        # stream has the full resolution of the sensor
+        return (
+            f'libcamerasrc camera-name="{globals.CAMERA_NAME}" name=cs '
+            'src::stream-role=view-finder src_0::stream-role=still-capture cs.src',
+            'cs.src_0',
+        )
+
+    def feed_simulated_frames(self, source):
+        from Entomoscope.simulation.virtual_microscope import get_microscope
+        microscope = get_microscope()
+        while True:
+            start = time.monotonic()
+            frame = microscope.render(globals.PIPELINE_WIDTH, globals.PIPELINE_HEIGHT)
+            source.emit('push-buffer', Gst.Buffer.new_wrapped(frame.tobytes()))
+            time.sleep(max(0.0, 1 / globals.SIM_FRAME_RATE - (time.monotonic() - start)))
+
     def on_sync_message(self, bus, msg):
         message_name = msg.get_structure().get_name()
         if message_name == 'prepare-window-handle':
@@ -33,7 +113,7 @@ class VideoWidget(QWidget):
             assert win_id
             imagesink = msg.src
             imagesink.set_window_handle(win_id)
-            
+
     def start_pipeline(self):
         self.pipeline.set_state(Gst.State.PLAYING)
         while self.pipeline.get_state(100).state != Gst.State.PLAYING:
@@ -42,4 +122,145 @@ class VideoWidget(QWidget):
     def pause_pipeline(self):
         self.pipeline.set_state(Gst.State.NULL)
         while self.pipeline.get_state(100).state != Gst.State.NULL:
-            pass
\ No newline at end of file
+            pass
+
+    def start_focus_analysis(self):
+        """Every frame of the focus branch updates globals.SHARPNESS"""
+        self.focus_valve.set_property('drop', False)
+
+    def stop_focus_analysis(self):
+        self.focus_valve.set_property('drop', True)
+
+    def start_focus_peaking(self):
+        """Shows the sharp edges of the live view in PEAKING_COLOR"""
+        with self.peaking_lock:
+            if self.peaking is None:
+                peaking = FocusPeaking(lambda overlay: self.show_peaking(peaking, overlay))
+                self.peaking = peaking
+                peaking.start()
+        self.peaking_valve.set_property('drop', False)
+
+    def stop_focus_peaking(self):
+        self.peaking_valve.set_property('drop', True)
+        with self.peaking_lock:
+            if self.peaking is not None:
+                self.peaking.interrupt()
+                self.peaking = None
+            self.peaking_overlay.set_property('alpha', 0.0)
+
+    def on_peaking_sample(self, sink):
+        sample = sink.emit('pull-sample')
+        if not isinstance(sample, Gst.Sample):
+            return Gst.FlowReturn.ERROR
+        peaking = self.peaking
+        # frames are only copied if they are not skipped
+        if peaking is not None and peaking.wants_frame():
+            peaking.submit(extract_gray(sample))
+        return Gst.FlowReturn.OK
+
+    def show_peaking(self, peaking, overlay):
+        """
+        Hands the RGBA overlay of peaking to the gdkpixbufoverlay, which
+        scales it to the preview and blends it into the following frames.
+        Called in the thread of peaking, overlays of a stopped one are
+        dropped.
+        """
+        height, width = overlay.shape[:2]
+        pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(overlay.tobytes()), GdkPixbuf.Colorspace.RGB,
+                                                 True, 8, width, height, 4 * width)
+        with self.peaking_lock:
+            if self.peaking is not peaking:
+                return
+            self.peaking_overlay.set_property('pixbuf', pixbuf)
+            self.peaking_overlay.set_property('alpha', 1.0)
+
+    def start_sweep_capture(self):
+        """Collects every frame of the sweep branch with its capture time until stop_sweep_capture"""
+        self.sweep_frames = []
+        self.sweep_valve.set_property('drop', False)
+
+    def stop_sweep_capture(self):
+        """Returns the collected frames as list of (monotonic capture time, BGR image)"""
+        self.sweep_valve.set_property('drop', True)
+        frames, self.sweep_frames = self.sweep_frames, None
+        return frames or []
+
+    def on_sweep_sample(self, sink):
+        sample = sink.emit('pull-sample')
+        if not isinstance(sample, Gst.Sample):
+            return Gst.FlowReturn.ERROR
+        frames = self.sweep_frames
+        if frames is not None:
+            frames.append((self.capture_time(sample), extract_buffer(sample)))
+        return Gst.FlowReturn.OK
+
+    def capture_time(self, sample):
+        """
+        Monotonic time in seconds the frame of sample was captured at. The
+        pipeline clock is the monotonic system clock, so it is the base
+        time plus the timestamp of the buffer; the arrival time if the
+        buffer has none.
+        """
+        pts = sample.get_buffer().pts
+        if pts == Gst.CLOCK_TIME_NONE:
+            return time.monotonic() - globals.SWEEP_FRAME_LATENCY
+        return (self.pipeline.get_base_time() + pts) / Gst.SECOND
+
+    def capture_still(self, timeout = None, not_before = None):
+        """
+        Returns the first full resolution frame captured at or after the
+        monotonic time not_before as BGR image, or None. Without not_before
+        it is the first frame captured after the call. Earlier frames may
+        have been exposed while the axis was moving and are discarded.
+        """
+        timeout = globals.PIPELINE_STILL_TIMEOUT if timeout is None else timeout
+        not_before = time.monotonic() if not_before is None else not_before
+        with self.still_lock:
+            # drop a frame left in the sink from the last capture
+            self.still_sink.emit('try-pull-sample', 0)
+            self.still_valve.set_property('drop', False)
+            try:
+                deadline = time.time() + timeout
+                while time.time() < deadline:
+                    sample = self.still_sink.emit('try-pull-sample', int((deadline - time.time()) * Gst.SECOND))
+                    if sample is None:
+                        break
+                    if self.capture_time(sample) < not_before:
+                        continue
+                    return extract_buffer(sample)
+            finally:
+                self.still_valve.set_property('drop', True)
+        logging.error(f'No still frame from the pipeline within {timeout}s')
+        return None
+
+
+class PipelineCamera():
+    """
+    Camera backend of the ImageCamera that takes the stills from the still
+    branch of the running live view pipeline. The camera is shared with the
+    live view, which keeps running during captures. With a linear_axis a
+    still is the first frame captured STACK_SETTLE_TIME after its last move,
+    so the caller does not need to wait for the axis to settle.
+    """
+    persistent = True
+    exclusive = False
+
+    def __init__(self, video_widget, linear_axis = None):
+        self.video_widget = video_widget
+        self.linear_axis = linear_axis
+        self.waits_for_axis = linear_axis is not None
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def capture(self):
+        not_before = None
+        if self.linear_axis is not None:
+            not_before = self.linear_axis.last_move_time() + globals.STACK_SETTLE_TIME
+        image = self.video_widget.capture_still(not_before=not_before)
+        if image is None:
+            raise IOError('The pipeline delivered no still frame')
+        return image
@@ -1,3 +1,4 @@
+import os
 
 USB_MOUNT_DIRECTORY = "/media/entomoscope"
 BIG_CHECKBOX_STYLE = "QCheckBox::indicator {width :80px;height : 80px;}"
@@ -18,6 +19,7 @@ MIN_RUNTIME_FOR_FAN_IN_SEC = 30
 VOLUME_DIR = '/mnt/ssd/'
 LOCAL_DIR = '/home/entomoscope/l'
 USB_DIR = '/home/entomoscope/u'
+W1_DEVICES_DIR = '/sys/bus/w1/devices/'
 
 
 
@@ -71,10 +73,327 @@ OFFSET = 50
 IMAGE_WIDTH = 50
 IMAGE_HEIGHT = 50
 
-# Step size for autofocus
+# Fusion used by Stacking.do_stacking: 'streaming', 'pyramid' or 'classic'
+# 'streaming' fuses the images one at a time in tiles and needs far less memory
+# 'pyramid' fuses on a Laplacian pyramid, which avoids halos at edges
+# Type: str
+# Unit: -
+FUSION_MODE = 'streaming'
+
+# Number of Laplacian levels for the 'pyramid' fusion
 # Type: int
-# Units: Steps
-STEP_SIZE = 400
+# Unit: -
+PYRAMID_FUSION_LEVELS = 5
+
+# Edge length of the tiles for the streaming fusion
+# Type: int
+# Unit: Pixels
+STACKING_TILE_SIZE = 512
+
+# Alignment used by Stacking.do_stacking: 'pyramid' or 'ecc'
+# 'pyramid' estimates the warp coarse to fine, 'ecc' only at full resolution
+# Type: str
+# Unit: -
+ALIGNMENT_MODE = 'pyramid'
+
+# Alignment strategy used by Stacking.do_stacking: 'chain' or 'reference'
+# 'chain' aligns each image to the previous one, 'reference' aligns all images
+# to the middle one in parallel (needs all images in memory)
+# Type: str
+# Unit: -
+ALIGNMENT_STRATEGY = 'chain'
+
+# Number of threads for the 'reference' alignment, None uses all cores
+# Type: int
+# Unit: -
+ALIGNMENT_WORKERS = None
+
+# Number of downscaled levels for the pyramid alignment
+# Type: int
+# Unit: -
+PYRAMID_ECC_LEVELS = 3
+
+# Maximum ECC iterations per downscaled level
+# Type: int
+# Unit: -
+PYRAMID_ECC_ITERATIONS = 50
+
+# Maximum ECC iterations at full resolution
+# Type: int
+# Unit: -
+PYRAMID_ECC_FINE_ITERATIONS = 10
+
+# ECC iterations between two convergence checks
+# Type: int
+# Unit: -
+PYRAMID_ECC_CHECK_INTERVAL = 5
+
+# A level is converged when the warp changes less than this
+# Type: float
+# Unit: Pixels (full resolution)
+PYRAMID_ECC_EPS = 0.05
+
+# File in each stack directory with the parameters the stack was taken with
+STACK_INFO_FILE_NAME = 'stack_info.json'
+
+# Write the index of the sharpest image per pixel as Depth_<name>.png next to
+# the stacked image
+SAVE_DEPTH_MAP = True
+
+# Fuse stacks while they are taken if stack fusion is enabled (see CaptureStacker)
+INCREMENTAL_STACKING = True
+
+# Time a stack dir has to be unchanged before the Stacker picks up images
+# added from outside
+# Type: float
+# Unit: Seconds
+STACKER_SETTLE_TIME = 5.0
+
+# Number of worker processes of the Stacker, None for one per core. Every
+# worker holds a stack in memory, so this is limited by the RAM of the Pi.
+STACKER_WORKERS = 2
+
+# Temperatures from which on the Stacker runs fewer jobs at once (linearly
+# down to none at the pause temperature), see ThermalGovernor. They are below
+# the 75°C at which the fan starts and the 80°C at which the firmware throttles.
+# Type: float
+# Unit: °C
+THERMAL_REDUCE_CPU_TEMP = 68.0
+THERMAL_PAUSE_CPU_TEMP = 78.0
+THERMAL_REDUCE_ENCLOSURE_TEMP = 40.0
+THERMAL_PAUSE_ENCLOSURE_TEMP = 45.0
+
+# Temperature drop needed before the number of jobs is raised again
+# Type: float
+# Unit: °C
+THERMAL_HYSTERESIS = 3.0
+
+# Interval in which the ThermalGovernor reads the temperatures
+# Type: float
+# Unit: Seconds
+THERMAL_POLL_INTERVAL = 2.0
+
+# Threads decoding the images of a stack ahead of the stacking in every worker
+DECODE_WORKERS = 2
+
+# Memory for images decoded ahead per stacking worker
+# Type: int
+# Unit: Bytes
+DECODE_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Stacks fused by the Stacker are decoded at 1/STACKING_DECODE_REDUCTION of
+# the resolution (1, 2, 4 or 8). Values above 1 give preview quality only,
+# written as Stacked_<stack>_r<reduction>.png next to the full resolution name.
+STACKING_DECODE_REDUCTION = 1
+
+# PNG compression level (0-9) of the Stacked_ images. Level 1 is several
+# times faster than the default of libpng at slightly bigger files.
+STACKED_IMAGE_PNG_LEVEL = 1
+
+# Additional files written from every stacked image, named
+# <prefix><name><extension> next to Stacked_<name>.png. format is one of
+# png (level), webp (lossless or quality), tiff (compression: 1 none,
+# 5 LZW, 8 Deflate) or jpg (quality); max_size is the longest side in pixels
+# or None for the full resolution. Prefixes must not start with Stacked_.
+STACKED_DERIVATIVES = [
+    {'prefix': 'Preview_', 'format': 'jpg', 'quality': 95, 'max_size': 1920},
+    {'prefix': 'Thumbnail_', 'format': 'jpg', 'quality': 85, 'max_size': 256},
+]
+
+# Threads encoding and writing the stacked images and their derivatives
+OUTPUT_WRITER_WORKERS = 3
+
+# Time window of the throughput and latency statistics of the Stacker
+# Type: float
+# Unit: Seconds
+STACKER_STATS_WINDOW = 600.0
+
+# SQLite journal of the stacking jobs inside the working dir (see StackJournal)
+STACK_JOURNAL_FILE_NAME = '.stacking_journal.sqlite'
+
+# Persistent cache of the warp of one stack step (see WarpCache)
+WARP_CACHE_PATH = '/home/entomoscope/warp_cache.json'
+
+# Largest correction of a cached warp by the check refinement for it to be
+# used without estimation
+# Type: float
+# Unit: Pixels (full resolution)
+WARP_CACHE_MAX_CORRECTION = 0.5
+
+# Iterations of the ECC refinement that checks a cached warp
+# Type: int
+WARP_CACHE_CHECK_ITERATIONS = 20
+
+# Backend of the ImageCamera: 'pipeline' takes the stills from the live view
+# pipeline, 'picamera2' keeps the camera open during a stack,
+# 'libcamera-still' starts a process per frame, 'fake' needs no camera
+CAMERA_BACKEND = 'pipeline'
+
+# Resolution of the full resolution stream of the live view pipeline, i.e.
+# of the stills it takes
+# Type: int
+# Unit: Pixels
+PIPELINE_WIDTH = 4056
+PIPELINE_HEIGHT = 3040
+
+# Resolution of the preview stream of the live view pipeline, which the
+# preview, the focus measure, the sweeps and the focus peaking are taken
+# from. Not below SWEEP_WIDTH x SWEEP_HEIGHT.
+# Type: int
+# Unit: Pixels
+PREVIEW_WIDTH = 1352
+PREVIEW_HEIGHT = 1014
+
+# Resolution of the frames the focus measure is computed on
+# Type: int
+# Unit: Pixels
+FOCUS_WIDTH = 640
+FOCUS_HEIGHT = 480
+
+# Focus measure of the live view, one of 'laplacian', 'tenengrad',
+# 'modified_laplacian' or 'normalized_variance'
+# Type: str
+FOCUS_METRIC = 'laplacian'
+
+# Region of the frame the focus measure is computed on as (x, y, width,
+# height), fractions of the frame; None for the whole frame
+# Type: tuple
+FOCUS_ROI = (0.25, 0.25, 0.5, 0.5)
+
+# Only every n-th pixel of every n-th row of the region is used
+# Type: int
+FOCUS_DECIMATION = 1
+
+# Show the sharp edges of the live view as overlay on the preview
+# Type: bool
+FOCUS_PEAKING = False
+
+# Resolution of the frames the focus peaking is computed on
+# Type: int
+# Unit: Pixels
+PEAKING_WIDTH = 508
+PEAKING_HEIGHT = 380
+
+# Minimum gradient (sum of the absolute Sobel derivatives) of an edge
+# Type: int
+PEAKING_THRESHOLD = 200
+
+# Color of the edges as (R, G, B)
+# Type: tuple
+PEAKING_COLOR = (255, 0, 0)
+
+# Frames are skipped to compute at most this many overlays per second and
+# to use at most this share of one CPU core
+# Type: float
+PEAKING_MAX_RATE = 5
+PEAKING_CPU_SHARE = 0.25
+
+# Time to wait for a still from the pipeline
+# Type: float
+# Unit: Seconds
+PIPELINE_STILL_TIMEOUT = 5.0
+
+# Time for auto exposure and white balance after the camera was opened
+# Type: float
+# Unit: Seconds
+CAMERA_SETTLE_TIME = 1.0
+
+# PNG compression level (0-9) of the images taken with a persistent backend
+RAW_IMAGE_PNG_LEVEL = 1
+
+# Frames of a stack waiting to be written at most, and threads writing them
+# (see StackAcquisition). A full resolution frame takes about 37 MB.
+STACK_ACQUISITION_QUEUE_SIZE = 3
+STACK_ACQUISITION_WRITERS = 2
+
+# How stacks are taken: 'steps' stops for every frame and takes full
+# resolution stills, 'sweep' moves the axis continuously and keeps the
+# preview resolution frames nearest to the focal planes (see
+# SweepAcquisition). A sweep needs the 'pipeline' camera backend.
+STACK_ACQUISITION_MODE = 'steps'
+
+# Resolution of the frames of a sweep
+# Type: int
+# Unit: Pixels
+SWEEP_WIDTH = 1352
+SWEEP_HEIGHT = 1014
+
+# Frame rate of the live view pipeline while sweeping and the number of
+# frames taken per focal plane, which give the speed of the sweep
+# Type: float
+# Unit: Frames per second
+SWEEP_FRAME_RATE = 10.0
+SWEEP_FRAMES_PER_PLANE = 3
+
+# Time from the capture of a frame to its arrival in the sweep branch, only
+# used for buffers without timestamp
+# Type: float
+# Unit: Seconds
+SWEEP_FRAME_LATENCY = 0.1
+
+# Time for the axis to come to rest after a step of a stack; the pipeline
+# camera uses the first frame captured this long after the move
+# Type: float
+# Unit: Seconds
+STACK_SETTLE_TIME = 0.1
+
+# Simulation
+
+# Run on the virtual microscope instead of the hardware (see
+# simulation/virtual_microscope.py), set with ENTOMOSCOPE_SIMULATION=1
+SIMULATION = os.environ.get('ENTOMOSCOPE_SIMULATION') == '1'
+
+# Resolution of the simulated camera
+# Type: int
+# Unit: Pixels
+SIM_WIDTH = 2028
+SIM_HEIGHT = 1520
+
+# Position of the axis at start, of the endstop and at which the base of
+# the specimen is in focus
+# Type: int
+# Unit: Microsteps
+SIM_START_POSITION = 20_000
+SIM_ENDSTOP_POSITION = 0
+SIM_FOCUS_POSITION = 60_000
+
+# Height of the specimen surface above its base
+# Type: float
+# Unit: Micrometer
+SIM_SPECIMEN_DEPTH = 1_500.0
+
+# Blur sigma per micrometer of defocus, the largest blur and the number of
+# blur levels rendered
+# Type: float
+# Unit: Pixels
+SIM_BLUR_PER_UM = 0.02
+SIM_MAX_BLUR = 12.0
+SIM_BLUR_LEVELS = 12
+
+# Sensor noise sigma of the simulated camera
+# Type: float
+# Unit: Gray values
+SIM_NOISE = 2.0
+
+# Exposure of a still and frame rate of the live view of the simulated camera
+# Type: float
+# Unit: Seconds, Frames per second
+SIM_EXPOSURE_TIME = 0.05
+SIM_FRAME_RATE = 10
+
+# Enclosure temperature of the simulated 1-Wire sensor and CPU temperature
+# where the host has no thermal zone
+# Type: float
+# Unit: °C
+SIM_ENCLOSURE_TEMP = 30.0
+SIM_CPU_TEMP = 50.0
+
+SIM_SEED = 0
+
+if SIMULATION:
+    # the live view runs at the resolution of the simulated camera
+    PIPELINE_WIDTH = SIM_WIDTH
+    PIPELINE_HEIGHT = SIM_HEIGHT
 
 # Step size for stacks
 # Type: int
@@ -84,4 +403,89 @@ STACK_STEP_SIZE = 500 #ggf. kleiner in 10er/25er Schritte
 # Step size for moving the focus
 # Type: int
 # Units: Steps
-FOCUS_STEP_SIZE = 125
\ No newline at end of file
+FOCUS_STEP_SIZE = 125
+
+# Distance of the positions of the coarse autofocus scan
+# Type: int
+# Units: Micrometer
+AUTOFOCUS_COARSE_STEP = 1600
+
+# Precision the autofocus refines the best position to
+# Type: int
+# Units: Micrometer
+AUTOFOCUS_FINE_STEP = 25
+
+# Time after which the autofocus stops refining and moves to the best
+# position measured so far
+# Type: float
+# Units: Seconds
+AUTOFOCUS_TIME_BUDGET = 20.0
+
+# Delay after a move of the axis before frames are used for the focus
+# measure, for vibrations to settle
+# Type: float
+# Units: Seconds
+FOCUS_SETTLE_TIME = 0.05
+
+# The coarse scan stops after two positions below this fraction of the best
+# sharpness
+# Type: float
+AUTOFOCUS_DROP_RATIO = 0.7
+
+# Distance of the positions of the scan around a predicted focus position
+# Type: int
+# Units: Micrometer
+AUTOFOCUS_WARM_STEP = 200
+
+# Half width of the window scanned around a predicted focus position, at
+# least the spread of the positions of the history
+# Type: int
+# Units: Micrometer
+AUTOFOCUS_WARM_MARGIN = 600
+
+# Persistent history of the autofocus positions (see FocusHistory)
+FOCUS_HISTORY_PATH = '/home/entomoscope/focus_history.json'
+
+# Latest autofocus positions per profile the prediction is based on
+# Type: int
+FOCUS_HISTORY_SIZE = 20
+
+# Profile of the focus history, to be changed with the pin holder or lens
+# Type: str
+FOCUS_PROFILE = 'default'
+
+# Distance positions below the current one are approached from below to
+# take up the backlash of the axis, 0 to move there directly
+# Type: int
+# Units: Micrometer
+AUTOFOCUS_BACKLASH = 0
+
+# Take stacks at the planes derived from the sharpness measured by the last
+# autofocus instead of the number of stacks and step size set in the UI
+# Type: bool
+STACK_BRACKETING = False
+
+# Grid of tiles (rows, columns) of the frame whose sharpness is followed
+# separately for the stack bracketing
+# Type: tuple
+BRACKETING_TILES = (4, 4)
+
+# Minimum ratio of the highest to the lowest sharpness of a tile for it to
+# contain a part of the specimen
+# Type: float
+BRACKETING_MIN_CONTRAST = 1.5
+
+# Distance of the planes of a bracketed stack as fraction of the depth of
+# field
+# Type: float
+BRACKETING_OVERLAP = 0.8
+
+# Optics of the camera for the depth of field of the stack bracketing
+# Type: float
+OPTICS_NUMERICAL_APERTURE = 0.05
+OPTICS_MAGNIFICATION = 2.0
+# Units: Micrometer
+OPTICS_PIXEL_SIZE = 1.55
+OPTICS_WAVELENGTH = 0.55
+# Type: float
+OPTICS_REFRACTIVE_INDEX = 1.0
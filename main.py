@@ -1,20 +1,33 @@
 import sys
-from PyQt5.QtWidgets import QApplication
-from Entomoscope.frontend.controller.fan_controller import FanController
-from Entomoscope.frontend.ui import Ui
 import os
 import logging
 
-stream = os.popen('rm -rf ~/l')
-output = stream.read()
-logging.info(output)
-stream = os.popen('rm -rf ~/u')
-output = stream.read()
-logging.info(output)
+if os.environ.get('ENTOMOSCOPE_SIMULATION') == '1':
+    # the stubs of RPi.GPIO, pigpio and gpiozero replace the hardware modules
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulation', 'stubs'))
 
-fan_controller = FanController()
-# fan_controller.start()
 
-app = QApplication(sys.argv)
-window = Ui('/home/entomoscope/entomoscope-software/Entomoscope/files/untitled.ui')
-app.exec_()
+def main():
+    # imported here, so the spawned stacking workers (which import this
+    # module) do not load the UI and the devices
+    from PyQt5.QtWidgets import QApplication
+    from Entomoscope.frontend.controller.fan_controller import FanController
+    from Entomoscope.frontend.ui import Ui
+
+    stream = os.popen('rm -rf ~/l')
+    output = stream.read()
+    logging.info(output)
+    stream = os.popen('rm -rf ~/u')
+    output = stream.read()
+    logging.info(output)
+
+    fan_controller = FanController()
+    # fan_controller.start()
+
+    app = QApplication(sys.argv)
+    window = Ui('/home/entomoscope/entomoscope-software/Entomoscope/files/untitled.ui', temp_sensor=fan_controller.temp_sensor)
+    app.exec_()
+
+
+if __name__ == '__main__':
+    main()
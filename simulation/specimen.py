@@ -0,0 +1,32 @@
+"""
+Synthetic specimen shared by the virtual microscope and the benchmarks: a
+sharp texture with thin lines like bristles and a depth map of its surface.
+"""
+import cv2
+import numpy
+
+
+def make_reference(width: int, height: int, seed: int = 0) -> numpy.ndarray:
+    """Sharp synthetic specimen: textured background with thin lines like bristles"""
+    rng = numpy.random.default_rng(seed)
+    texture = numpy.zeros((height, width), dtype=numpy.float32)
+    for scale in (4, 16, 64):
+        noise = rng.random((height // scale + 1, width // scale + 1), dtype=numpy.float32)
+        texture += cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    texture = cv2.normalize(texture, None, 40, 200, cv2.NORM_MINMAX)
+    image = cv2.cvtColor(texture.astype(numpy.uint8), cv2.COLOR_GRAY2BGR)
+    for _ in range(max(width, height) // 8):
+        x0, x1 = rng.integers(0, width, 2)
+        y0, y1 = rng.integers(0, height, 2)
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.line(image, (int(x0), int(y0)), (int(x1), int(y1)), color, 1, cv2.LINE_AA)
+    return image
+
+
+def make_depth(width: int, height: int) -> numpy.ndarray:
+    """Depth of the specimen in [0, 1]: a tilted dome"""
+    y, x = numpy.mgrid[0:height, 0:width].astype(numpy.float32)
+    x = (x - width / 2) / (width / 2)
+    y = (y - height / 2) / (height / 2)
+    depth = 0.7 * numpy.clip(1 - (x ** 2 + y ** 2) / 2, 0, 1) + 0.3 * (x + 1) / 2
+    return cv2.normalize(depth, None, 0, 1, cv2.NORM_MINMAX)
@@ -0,0 +1,64 @@
+"""RPi.GPIO stub forwarding to the virtual microscope (see simulation.virtual_microscope)"""
+BCM = 11
+BOARD = 10
+IN = 1
+OUT = 0
+HIGH = 1
+LOW = 0
+PUD_UP = 22
+PUD_DOWN = 21
+PUD_OFF = 20
+
+_levels = {}
+
+
+def _microscope():
+    from Entomoscope.simulation.virtual_microscope import get_microscope
+    return get_microscope()
+
+
+def setwarnings(flag):
+    pass
+
+
+def setmode(mode):
+    # creates the virtual microscope, which also sets up the 1-Wire sensor
+    _microscope()
+
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=None):
+    if initial is not None:
+        _levels[channel] = initial
+
+
+def output(channel, value):
+    _levels[channel] = int(value)
+
+
+def input(channel):
+    if channel in _levels:
+        return _levels[channel]
+    return _microscope().gpio_input(channel)
+
+
+def cleanup(channel=None):
+    _levels.clear()
+
+
+class PWM():
+    def __init__(self, channel, frequency):
+        self.channel = channel
+        self.frequency = frequency
+        self.duty_cycle = 0
+
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.duty_cycle = 0
@@ -0,0 +1,8 @@
+"""gpiozero stub forwarding to the virtual microscope (see simulation.virtual_microscope)"""
+
+
+class CPUTemperature():
+    @property
+    def temperature(self):
+        from Entomoscope.simulation.virtual_microscope import get_microscope
+        return get_microscope().cpu_temperature()
@@ -0,0 +1,15 @@
+"""pigpio stub forwarding to the virtual microscope (see simulation.virtual_microscope)"""
+INPUT = 0
+OUTPUT = 1
+
+
+class pulse():
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+
+def pi():
+    from Entomoscope.simulation.virtual_microscope import get_microscope
+    return get_microscope().pi
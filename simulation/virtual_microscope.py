@@ -0,0 +1,234 @@
+"""
+Virtual microscope for running the backend and the UI without a Pi. It models
+the stepper driver behind pigpio (wave timing and speed), the endstop switch,
+a 1-Wire temperature sensor and a camera that renders the synthetic specimen
+defocused according to the position of the simulated axis.
+
+The stub modules in simulation/stubs (RPi.GPIO, pigpio, gpiozero) forward to
+the VirtualMicroscope returned by get_microscope(). They have to be found
+before the real modules, i.e. simulation/stubs must be on sys.path before
+Entomoscope is imported. main.py does this when ENTOMOSCOPE_SIMULATION=1 is
+set; scripts and CI can set PYTHONPATH instead.
+"""
+from threading import Lock
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+import Entomoscope.globals as globals
+import Entomoscope.backend.configuration as configuration
+from Entomoscope.simulation.specimen import make_reference, make_depth
+
+_microscope = None
+_microscope_lock = Lock()
+
+
+def get_microscope():
+    """The virtual microscope of this process, created on first use"""
+    global _microscope
+    with _microscope_lock:
+        if _microscope is None:
+            _microscope = VirtualMicroscope()
+        return _microscope
+
+
+class SimulatedPi():
+    """
+    The subset of pigpio.pi used by Motor. A wave of one pulse pair is one
+    microstep, its duration gives the speed. Chains and repeated waves move
+    the simulated axis in real time; the direction is read from the level of
+    the direction pin when a wave starts.
+    """
+    def __init__(self, start_position = 0):
+        self.lock = Lock()
+        self.levels = {}
+        self.pending_pulses = []
+        self.waves = {}
+        self.next_wave_id = 0
+        self.position = float(start_position)
+        # (start time, start position, direction, steps per second, steps or None for endless)
+        self.motion = None
+
+    def set_mode(self, gpio, mode):
+        pass
+
+    def write(self, gpio, level):
+        self.levels[gpio] = int(level)
+
+    def read(self, gpio):
+        return self.levels.get(gpio, 0)
+
+    def wave_clear(self):
+        self.pending_pulses = []
+
+    def wave_add_generic(self, pulses):
+        self.pending_pulses += pulses
+        return len(self.pending_pulses)
+
+    def wave_create(self):
+        wave_id = self.next_wave_id
+        self.next_wave_id += 1
+        # duration of the wave in microseconds
+        self.waves[wave_id] = sum(pulse.delay for pulse in self.pending_pulses)
+        self.pending_pulses = []
+        return wave_id
+
+    def wave_delete(self, wave_id):
+        self.waves.pop(wave_id, None)
+
+    def wave_send_repeat(self, wave_id):
+        self._start(wave_id, None)
+
+    def wave_chain(self, chain):
+        # the chains of Motor: 255 0 <wave> 255 1 <x> <y> repeats wave x + 256 y times
+        steps = 0
+        wave_id = None
+        i = 0
+        while i < len(chain):
+            if chain[i] == 255 and chain[i + 1] == 0:
+                i += 2
+            elif chain[i] == 255 and chain[i + 1] == 1:
+                steps += chain[i + 2] + 256 * chain[i + 3]
+                i += 4
+            else:
+                wave_id = chain[i]
+                i += 1
+        if wave_id is not None:
+            self._start(wave_id, steps)
+
+    def wave_tx_busy(self):
+        with self.lock:
+            self._update()
+            return int(self.motion is not None)
+
+    def wave_tx_stop(self):
+        with self.lock:
+            self._update()
+            if self.motion is not None:
+                self.position = self._position_at(time.monotonic())
+                self.motion = None
+
+    def get_position(self):
+        """Position of the axis in microsteps"""
+        with self.lock:
+            self._update()
+            if self.motion is None:
+                return self.position
+            return self._position_at(time.monotonic())
+
+    def _start(self, wave_id, steps):
+        with self.lock:
+            self._update()
+            if self.motion is not None:
+                self.position = self._position_at(time.monotonic())
+            direction = 1 if self.levels.get(configuration.DIRECTION_PIN, 0) == 1 else -1
+            speed = 1e6 / self.waves[wave_id]
+            self.motion = (time.monotonic(), self.position, direction, speed, steps)
+
+    def _position_at(self, timestamp):
+        start_time, start_position, direction, speed, steps = self.motion
+        moved = (timestamp - start_time) * speed
+        if steps is not None:
+            moved = min(moved, steps)
+        return start_position + direction * int(moved)
+
+    def _update(self):
+        """Ends a finished chain"""
+        if self.motion is None or self.motion[4] is None:
+            return
+        start_time, start_position, direction, speed, steps = self.motion
+        if (time.monotonic() - start_time) * speed >= steps:
+            self.position = start_position + direction * steps
+            self.motion = None
+
+
+class VirtualMicroscope():
+    """
+    Simulated hardware of the Entomoscope. The axis position is in microsteps
+    from the endstop, which is pressed at and below SIM_ENDSTOP_POSITION. The
+    specimen surface is in focus at SIM_FOCUS_POSITION plus its depth map
+    times SIM_SPECIMEN_DEPTH, and the blur grows by SIM_BLUR_PER_UM per
+    micrometer of defocus up to SIM_MAX_BLUR.
+    """
+    def __init__(self):
+        self.pi = SimulatedPi(globals.SIM_START_POSITION)
+        self.um_per_mic_step = configuration.DISTANCE_PER_REVOLUTION / (configuration.STEPS_PER_REVOLUTION * configuration.MIC_RESOLUTION)
+        self.width = globals.SIM_WIDTH
+        self.height = globals.SIM_HEIGHT
+        self.reference = make_reference(self.width, self.height, globals.SIM_SEED)
+        self.depth = make_depth(self.width, self.height)
+        self.rng = np.random.default_rng(globals.SIM_SEED)
+        self.blurred = None
+        self.render_lock = Lock()
+        self.setup_temperature_sensor()
+
+    def setup_temperature_sensor(self):
+        """Writes a 1-Wire device file and points TemperaureSensor to it"""
+        w1_dir = tempfile.mkdtemp(prefix='entomoscope_w1_')
+        device_dir = os.path.join(w1_dir, '28-000000000000')
+        os.makedirs(device_dir)
+        with open(os.path.join(device_dir, 'w1_slave'), 'w') as f:
+            f.write('50 01 4b 46 7f ff 0c 10 1c : crc=1c YES\n')
+            f.write(f'50 01 4b 46 7f ff 0c 10 1c t={int(globals.SIM_ENCLOSURE_TEMP * 1000)}\n')
+        globals.W1_DEVICES_DIR = w1_dir + '/'
+
+    def gpio_input(self, pin):
+        if pin == configuration.AXES_STOP_SWITCH_PIN:
+            return int(self.endstop_pressed())
+        return 0
+
+    def endstop_pressed(self):
+        return self.pi.get_position() <= globals.SIM_ENDSTOP_POSITION
+
+    def cpu_temperature(self):
+        try:
+            with open('/sys/class/thermal/thermal_zone0/temp') as f:
+                return int(f.read()) / 1000
+        except (OSError, ValueError):
+            return globals.SIM_CPU_TEMP
+
+    def focus_offset(self):
+        """Distance of the focal plane to the sharp plane of the specimen base in micrometers"""
+        return (self.pi.get_position() - globals.SIM_FOCUS_POSITION) * self.um_per_mic_step
+
+    def render(self, width = None, height = None):
+        """Frame of the camera at the current axis position as BGR image"""
+        with self.render_lock:
+            if self.blurred is None:
+                # every blur level of the specimen once, frames only pick from them
+                levels = []
+                for level in range(globals.SIM_BLUR_LEVELS):
+                    sigma = globals.SIM_MAX_BLUR * level / (globals.SIM_BLUR_LEVELS - 1)
+                    levels.append(self.reference if sigma == 0 else cv2.GaussianBlur(self.reference, (0, 0), sigma))
+                self.blurred = np.stack(levels)
+            defocus = np.abs(self.focus_offset() - self.depth * globals.SIM_SPECIMEN_DEPTH)
+            sigma = np.minimum(defocus * globals.SIM_BLUR_PER_UM, globals.SIM_MAX_BLUR)
+            level = np.rint(sigma / globals.SIM_MAX_BLUR * (globals.SIM_BLUR_LEVELS - 1)).astype(np.intp)
+            frame = np.take_along_axis(self.blurred, level[None, :, :, None], axis=0)[0]
+            if globals.SIM_NOISE:
+                noise = self.rng.normal(0, globals.SIM_NOISE, frame.shape).astype(np.float32)
+                frame = np.clip(frame.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+        if width is not None and height is not None and (width, height) != (self.width, self.height):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        return frame
+
+
+class SimulatedCamera():
+    """Camera backend of the ImageCamera rendering frames of the virtual microscope"""
+    persistent = True
+    exclusive = False
+    waits_for_axis = False
+
+    def __init__(self, microscope = None):
+        self.microscope = microscope if microscope is not None else get_microscope()
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def capture(self) -> np.ndarray:
+        time.sleep(globals.SIM_EXPOSURE_TIME)
+        return self.microscope.render()
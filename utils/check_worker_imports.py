@@ -0,0 +1,42 @@
+"""
+Checks that the stacking worker processes of the Stacker do not load the UI,
+GStreamer or the GPIO drivers. A spawned worker imports the module of
+run_stacking_job in a fresh interpreter, which runs the package __init__s,
+so these have to import their submodules lazily.
+
+Run from the directory containing the Entomoscope package:
+
+    python -m Entomoscope.utils.check_worker_imports
+
+It exits with status 1 if a forbidden module is loaded and with status 2 if
+the module can not be imported at all, so it can run in CI.
+"""
+import subprocess
+import sys
+
+WORKER_MODULE = 'Entomoscope.frontend.controller.stacking_job'
+FORBIDDEN_MODULES = ['PyQt5', 'gi', 'RPi', 'pigpio', 'gpiozero', 'Entomoscope.frontend.ui']
+
+
+def loaded_modules(module):
+    """Top level and Entomoscope modules loaded by importing module in a fresh interpreter"""
+    code = (f'import sys, {module}\n'
+            'print("\\n".join(sys.modules))')
+    result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(f'Could not import {module}:\n{result.stderr.decode("utf-8")}', file=sys.stderr)
+        sys.exit(2)
+    return set(result.stdout.decode('utf-8').split())
+
+
+def main():
+    modules = loaded_modules(WORKER_MODULE)
+    loaded = [name for name in FORBIDDEN_MODULES if name in modules]
+    if loaded:
+        print(f'Importing {WORKER_MODULE} loads {", ".join(loaded)}')
+        sys.exit(1)
+    print(f'Importing {WORKER_MODULE} loads none of {", ".join(FORBIDDEN_MODULES)}')
+
+
+if __name__ == '__main__':
+    main()
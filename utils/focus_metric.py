@@ -0,0 +1,105 @@
+import time
+import cv2
+import numpy as np
+
+# second derivative in one direction for the modified Laplacian
+_D2X = np.array([[-1, 2, -1]], dtype=np.float32)
+_D2Y = _D2X.T
+
+
+def variance_of_laplacian(gray):
+    laplacian = cv2.Laplacian(gray, cv2.CV_16S)
+    _, std = cv2.meanStdDev(laplacian)
+    return float(std[0, 0]) ** 2
+
+
+def tenengrad(gray):
+    """Mean squared magnitude of the Sobel gradient"""
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+    return float(cv2.mean(cv2.multiply(gx, gx) + cv2.multiply(gy, gy))[0])
+
+
+def modified_laplacian(gray):
+    """Mean of |d2I/dx2| + |d2I/dy2|"""
+    d2x = cv2.filter2D(gray, cv2.CV_16S, _D2X)
+    d2y = cv2.filter2D(gray, cv2.CV_16S, _D2Y)
+    return float(cv2.mean(cv2.absdiff(d2x, 0) + cv2.absdiff(d2y, 0))[0])
+
+
+def normalized_variance(gray):
+    """Gray level variance divided by the mean brightness"""
+    mean, std = cv2.meanStdDev(gray)
+    mean = float(mean[0, 0])
+    return float(std[0, 0]) ** 2 / mean if mean > 0 else 0.0
+
+
+METRICS = {
+    'laplacian': variance_of_laplacian,
+    'tenengrad': tenengrad,
+    'modified_laplacian': modified_laplacian,
+    'normalized_variance': normalized_variance,
+}
+
+
+class FocusMetric:
+    """
+    Computes a focus measure of 8 bit gray frames. The region of interest is
+    a view into the frame, so the frame may be a buffer mapped from
+    GStreamer that is not copied. With a decimation above 1 only every
+    decimation-th pixel of every decimation-th row is used, which makes a
+    small contiguous copy. The time of the last computation and the mean
+    over all computations are kept for reporting.
+
+    :param metric:
+        one of METRICS
+    :param roi:
+        (x, y, width, height) as fractions of the frame, None for the whole
+        frame
+    """
+    def __init__(self, metric='laplacian', roi=None, decimation=1):
+        if metric not in METRICS:
+            raise ValueError(f'Focus metric must be one of {sorted(METRICS)}')
+        if decimation < 1:
+            raise ValueError('Decimation must be at least 1')
+        self.name = metric
+        self.metric = METRICS[metric]
+        self.roi = roi
+        self.decimation = decimation
+        self.compute_time = 0.0
+        self.frames = 0
+        self.total_time = 0.0
+
+    def region(self, gray):
+        """The region of interest of gray, decimated"""
+        if self.roi is not None:
+            height, width = gray.shape[:2]
+            x, y, w, h = self.roi
+            x0, y0 = int(x * width), int(y * height)
+            gray = gray[y0:y0 + max(1, int(h * height)), x0:x0 + max(1, int(w * width))]
+        if self.decimation > 1:
+            gray = np.ascontiguousarray(gray[::self.decimation, ::self.decimation])
+        return gray
+
+    def __call__(self, gray):
+        start = time.perf_counter()
+        value = self.metric(self.region(gray))
+        self.compute_time = time.perf_counter() - start
+        self.frames += 1
+        self.total_time += self.compute_time
+        return value
+
+    def tiles(self, gray, rows, columns):
+        """
+        Measures of a rows x columns grid of tiles of the whole gray frame,
+        decimated but regardless of the region of interest, as a list of rows
+        """
+        if self.decimation > 1:
+            gray = np.ascontiguousarray(gray[::self.decimation, ::self.decimation])
+        height, width = gray.shape[:2]
+        return [[self.metric(gray[height * row // rows:height * (row + 1) // rows,
+                                  width * column // columns:width * (column + 1) // columns])
+                 for column in range(columns)] for row in range(rows)]
+
+    def mean_compute_time(self):
+        return self.total_time / self.frames if self.frames else 0.0
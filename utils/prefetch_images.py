@@ -0,0 +1,56 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+# imread flags for decoding at 1/reduction of the resolution
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def prefetch_images(paths, workers=2, memory_budget=None, reduction=1):
+    """
+    Yields the images at paths in order while the following ones are decoded
+    in a thread pool (cv2 releases the GIL while decoding), so decoding
+    overlaps the work on the yielded images. The decoded images waiting
+    to be yielded are bounded by memory_budget in bytes; the size of an
+    image is taken from the first one. A path that can not be read raises
+    an IOError: skipping it would shift the index of every later image,
+    which is the position of its focal plane.
+
+    :param reduction:
+        decode at 1/reduction of the resolution, one of 1, 2, 4 or 8
+    """
+    if reduction not in REDUCED_FLAGS:
+        raise ValueError(f'Reduction must be one of {sorted(REDUCED_FLAGS)}')
+    flags = REDUCED_FLAGS[reduction]
+    paths = iter(paths)
+    pending = deque()
+    # one image ahead until the size of an image is known
+    max_ahead = 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                while len(pending) < max_ahead:
+                    path = next(paths, None)
+                    if path is None:
+                        break
+                    pending.append((path, pool.submit(cv2.imread, path, flags)))
+                if not pending:
+                    return
+                path, future = pending.popleft()
+                image = future.result()
+                if image is None:
+                    raise IOError(f'Could not read image {path}')
+                if max_ahead == 1:
+                    if memory_budget is None:
+                        max_ahead = workers
+                    else:
+                        max_ahead = max(1, memory_budget // image.nbytes)
+                yield image
+        finally:
+            for _, future in pending:
+                future.cancel()
@@ -0,0 +1,20 @@
+import os
+import cv2
+
+
+def write_image_atomic(path, image, params=()):
+    """
+    Encodes the image in the format given by the extension of path and writes
+    it to a temporary file that is renamed to path, so readers never see a
+    partly written image.
+    """
+    success, buffer = cv2.imencode(os.path.splitext(path)[1], image, list(params))
+    if not success:
+        return False
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return True